@@ -9,7 +9,7 @@ tasks_serializer = api_manager.model('task', {
 	'username': fields.String(required=True, description='The user that started the task'),
 	'start': fields.DateTime(required=False, description='The date and time this task was started'),
 	'end': fields.DateTime(required=False, description='The date and time this task finished'),
-	'status': fields.Integer(required=True, description='The status of the task - 0: in progress, 1: success, 2: failure, 3: warnings'),
+	'status': fields.Integer(required=True, description='The status of the task - 0: in progress, 1: success, 2: failure, 3: warnings, 5: queued'),
 	'description': fields.String(required=False, description='The description of the task'),
 })
 
@@ -532,11 +532,27 @@ Username:             %s
 		  `username` varchar(64) NOT NULL,
 		  `start` datetime NOT NULL,
 		  `end` datetime DEFAULT NULL,
-		  `status` tinyint(4) NOT NULL DEFAULT '0' COMMENT '0: in progress, 1: success, 2: failure, 3: warning',
+		  `status` tinyint(4) NOT NULL DEFAULT '0' COMMENT '0: in progress, 1: success, 2: failure, 3: warning, 5: queued',
 		  `description` text,
 		  PRIMARY KEY (`id`)
 		) ENGINE=InnoDB DEFAULT CHARSET=utf8;""")
 
+		cursor.execute("""CREATE TABLE IF NOT EXISTS `task_queue` (
+		  `task_id` mediumint(11) NOT NULL,
+		  `type` varchar(16) NOT NULL,
+		  `name` varchar(64) NOT NULL,
+		  `file` varchar(255) NOT NULL,
+		  `options` mediumtext,
+		  `priority` smallint(6) NOT NULL DEFAULT '0',
+		  `interactive` tinyint(1) NOT NULL DEFAULT '1',
+		  `retryable` tinyint(1) NOT NULL DEFAULT '0',
+		  `attempts` tinyint(4) NOT NULL DEFAULT '0',
+		  `lease_expires` datetime DEFAULT NULL COMMENT 'NULL: waiting to be started',
+		  PRIMARY KEY (`task_id`),
+		  KEY `task_queue_lease` (`lease_expires`),
+		  CONSTRAINT `task_queue_ibfk_1` FOREIGN KEY (`task_id`) REFERENCES `tasks` (`id`) ON DELETE CASCADE
+		) ENGINE=InnoDB DEFAULT CHARSET=utf8;""")
+
 		cursor.execute("""CREATE TABLE IF NOT EXISTS `puppet_nodes` (
 		  `id` mediumint(11) NOT NULL,
 		  `certname` varchar(255) NOT NULL,
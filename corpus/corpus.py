@@ -9,6 +9,7 @@ import smtplib
 import socket
 import ssl
 import sys
+import syslog
 import time
 import xmlrpc.client  # for RHN5 API support
 from email.mime.text import MIMEText
@@ -24,10 +25,11 @@ from itsdangerous import JSONWebSignatureSerializer
 from pyVim.connect import SmartConnect
 # For VMware
 # pylint: disable=no-name-in-module
-from pyVmomi import vim, vmodl
+from pyVmomi import SoapStubAdapter, vim, vmodl
 
 
-from . import x509utils
+from . import puppet_enc_cache, x509utils
+from .servicenow_api import ServiceNowAPI
 # pylint: enable=no-name-in-module
 
 # Disable insecure platform warnings
@@ -65,6 +67,16 @@ class Corpus:
 		self.rdb = self._connect_redis()
 		self.x509utils = x509utils
 
+		# Indexes of VMware objects by name, see vmware_get_obj
+		self.vmware_obj_index = {}
+
+		# Connections to each vCenter, see vmware_smartconnect
+		self.vmware_sessions = {}
+
+		# Called before waiting for anything which might take a while, so
+		# that a task's buffered events are written first (see TaskHelper)
+		self.before_wait = None
+
 		# Regex for TSM matches. Matches nodenames of the format:
 		#  FQDN
 		#  PREFIX_FQDN
@@ -465,9 +477,91 @@ class Corpus:
 		Return an object by name, if name is None the
 		first found object is returned. Searches within
 		content.rootFolder (i.e. everything on the vCenter)
+		using an index of the names of every object of the
+		given types, which is built on first use and rebuilt
+		when it is older than VMWARE_OBJ_INDEX_TTL seconds or
+		when the name can't be found in it
+		"""
+
+		for rebuild in [False, True]:
+			index = self._vmware_obj_index(content, vimtype, rebuild)
+
+			if name:
+				obj = index.get(name)
+			else:
+				obj = next(iter(index.values()), None)
+
+			# Check the object hasn't been renamed or deleted since the
+			# index was built (which costs one call rather than a full scan)
+			try:
+				if obj is not None and (not name or obj.name == name):
+					return obj
+			except vmodl.fault.ManagedObjectNotFound:
+				pass
+
+		return None
+
+	################################################################################
+
+	def _vmware_obj_index(self, content, vimtype, rebuild=False):
+		"""
+		Returns a dictionary mapping the name of every object of the given
+		types on a vCenter to the object, building it in one property
+		collector call if it doesn't exist, has expired or rebuild is True
+		"""
+
+		# pylint: disable=protected-access
+		key = (content.propertyCollector._stub, tuple(vimtype))
+		if not rebuild and key in self.vmware_obj_index and self.vmware_obj_index[key][0] > time.time():
+			return self.vmware_obj_index[key][1]
+
+		container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
+		try:
+			objects = self._vmware_collect_names(content, container, vimtype)
+		finally:
+			container.Destroy()
+
+		## Where more than one object has the same name keep the first, as
+		## searching the container view would
+		index = {}
+		for obj, obj_name in objects:
+			index.setdefault(obj_name, obj)
+
+		self.vmware_obj_index[key] = (time.time() + self.config.get('VMWARE_OBJ_INDEX_TTL', 300), index)
+		return index
+
+	################################################################################
+
+	def vmware_invalidate_obj_index(self, content=None):
+		"""
+		Throws away the indexes used by vmware_get_obj for the vCenter that
+		content belongs to, or for every vCenter if content is None. Call
+		this after creating or renaming objects that will then be looked up.
+		"""
+
+		# pylint: disable=protected-access
+		for key in list(self.vmware_obj_index.keys()):
+			if content is None or key[0] is content.propertyCollector._stub:
+				del self.vmware_obj_index[key]
+
+	################################################################################
+
+	def _vmware_collect_names(self, content, container, vimtype):
 		"""
+		Returns a list of (object, name) tuples for every object of the
+		given types in a container view, in the order of the view
+		"""
+
+		# pylint: disable=protected-access
+		service_instance = vim.ServiceInstance('ServiceInstance', content.propertyCollector._stub)
+		objects = self.vmware_collect_properties_by_type(service_instance, container, dict((obj_type, ['name']) for obj_type in vimtype))
 
-		return self.vmware_get_obj_within_parent(content, vimtype, name, content.rootFolder)
+		names = {}
+		for obj_type in objects:
+			for moId in objects[obj_type]:
+				names[moId] = objects[obj_type][moId].get('name')
+
+		return [(obj, names[obj._moId]) for obj in container.view if obj._moId in names]
 
 	################################################################################
 
@@ -480,14 +574,17 @@ class Corpus:
 		"""
 		obj = None
 		container = content.viewManager.CreateContainerView(parent, vimtype, True)
-		for cont in container.view:
+		try:
 			if name:
-				if cont.name == name:
-					obj = cont
-					break
-			else:
-				obj = cont
-				break
+				# Get the names of every object in one call rather than one each
+				for cont, cont_name in self._vmware_collect_names(content, container, vimtype):
+					if cont_name == name:
+						obj = cont
+						break
+			elif len(container.view) > 0:
+				obj = container.view[0]
+		finally:
+			container.Destroy()
 
 		return obj
 
@@ -495,46 +592,44 @@ class Corpus:
 
 	def vmware_get_obj_by_id(self, content, vimtype, moid):
 		"""
-		Return an object by moId. Set parent to be
-		a Folder, Datacenter, ComputeResource or ResourcePool under
-		which to search for the object.
+		Return an object by moId. The object is created directly
+		from the moId rather than by searching the vCenter, and then
+		checked to exist. Returns None if there is no object with
+		the moId of any of the given types.
 		"""
 
 		# pylint: disable=protected-access
+		for obj_type in vimtype:
+			obj = obj_type(moid, content.propertyCollector._stub)
+			try:
+				# Reading a property makes vCenter check the object exists
+				# (and that it is of the given type)
+				obj.name # pylint: disable=pointless-statement
+			except vmodl.fault.ManagedObjectNotFound:
+				continue
 
-		obj = None
-		container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-		for cont in container.view:
-			if cont._moId == moid:
-				obj = cont
-				break
+			return obj
 
-		return obj
+		return None
 
 	################################################################################
 
-	def vmware_task_wait(self, task, timeout=None):
-		"""Waits for vCenter task to finish"""
+	def _before_wait(self):
+		"""Calls the before_wait callback, if there is one"""
 
-		# Initialise our timer
-		timer = 0
+		if self.before_wait is not None:
+			self.before_wait()
 
-		while True:
-			if task.info.state == 'success':
-				return True
-
-			if task.info.state == 'error':
-				return False
+	################################################################################
 
-			## other states are 'queued' and 'running'
-			## which we should just wait on.
+	def vmware_task_wait(self, task, timeout=None):
+		"""Waits for vCenter task to finish"""
 
-			if timeout and timer > timeout:
-				return False
+		## Returns False on error or if we time out waiting
+		for _task, state in list(self.vmware_wait_for_tasks([task], timeout)):
+			return state == 'success'
 
-			## lets not busy wait CPU 100%...
-			time.sleep(1)
-			timer = timer + 1
+		return False
 
 	################################################################################
 
@@ -545,11 +640,8 @@ class Corpus:
 		does not return a variable.
 		"""
 
-		while True:
-			if task.info.state == 'success':
-				return
-
-			if task.info.state == 'error':
+		for _task, state in list(self.vmware_wait_for_tasks([task])):
+			if state == 'error':
 
 				## Try to get a meaningful error message
 				if hasattr(task.info.error, 'msg'):
@@ -561,9 +653,61 @@ class Corpus:
 
 				raise RuntimeError(on_error + error_message)
 
-			## If not success or error, then sleep a bit and check again.
-			## Otherwise we just busywaitloop the CPU at 100% for no reason.
-			time.sleep(1)
+	################################################################################
+
+	def vmware_wait_for_tasks(self, tasks, timeout=None):
+		"""
+		Waits for any number of vCenter tasks to finish, yielding each task as
+		soon as it does. vCenter only tells us when the state of a task changes
+		rather than us asking it for every task's info over and over again.
+		Args:
+		   tasks (list): The vim.Task objects to wait for, all on the same vCenter
+		   timeout: The maximum number of seconds to wait for all the tasks to
+		            finish, or None to wait forever
+		Yields:
+		   A (task, state) tuple as each task finishes, where state is either
+		   'success' or 'error'. Tasks which have not finished when the timeout
+		   is reached are not yielded.
+		"""
+
+		# Write out any buffered task events before we start waiting
+		self._before_wait()
+
+		if not tasks:
+			return
+
+		# Use our own property collector so that we don't interfere with, or
+		# see the updates of, anything else using this session
+		service_instance = vim.ServiceInstance('ServiceInstance', tasks[0]._stub)
+		property_collector = service_instance.content.propertyCollector.CreatePropertyCollector()
+
+		try:
+			property_collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+				objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=task) for task in tasks],
+				propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state'])]
+			), True)
+
+			pending = {task._moId: task for task in tasks}
+			version = ''
+			deadline = None if timeout is None else time.time() + timeout
+
+			while pending:
+				if deadline is None:
+					wait = 300
+				elif time.time() < deadline:
+					wait = deadline - time.time()
+				else:
+					return
+
+				## The first update contains the current state of every task,
+				## other states are 'queued' and 'running' which we wait on.
+				version, changes = self.vmware_wait_for_property_changes(property_collector, version, wait)
+				for obj, change in changes:
+					if change.val in ('success', 'error') and obj._moId in pending:
+						yield pending.pop(obj._moId), change.val
+
+		finally:
+			property_collector.Destroy()
 
 	################################################################################
 
@@ -678,8 +822,17 @@ class Corpus:
 	################################################################################
 
 	def vmware_smartconnect(self, tag):
+		"""Returns a ServiceInstance connected to the given vCenter. Rather than
+		logging in every time, the session cookie is shared through Redis with
+		every other task and web request, so a login is only needed when there
+		is no shared session or it has expired. Connections are also reused
+		within this object, being checked again after a minute."""
 
-		# pylint: disable=invalid-name
+		# pylint: disable=invalid-name,protected-access
+
+		## Reuse our own connection if it was checked recently
+		if tag in self.vmware_sessions and self.vmware_sessions[tag][1] > time.time() - 60:
+			return self.vmware_sessions[tag][0]
 
 		instance = self.config['VMWARE'][tag]
 
@@ -690,7 +843,38 @@ class Corpus:
 				sslContext.check_hostname = False
 				sslContext.verify_mode = ssl.CERT_NONE
 
-		return SmartConnect(host=instance['hostname'], user=instance['user'], pwd=instance['pass'], port=instance['port'], sslContext=sslContext)
+		key = 'vmware/session/' + tag
+		share = self.config.get('VMWARE_SESSION_SHARE', False)
+
+		## Try the shared session first
+		if share:
+			try:
+				session = self.rdb.get(key)
+				if session is not None:
+					session = json.loads(session)
+					stub = SoapStubAdapter(host=instance['hostname'], port=int(instance['port']), version=session['version'], sslContext=sslContext)
+					stub.cookie = session['cookie']
+					si = vim.ServiceInstance('ServiceInstance', stub)
+
+					# The current session is None if the cookie is no longer valid
+					if si.content.sessionManager.currentSession is not None:
+						self.rdb.expire(key, self.config.get('VMWARE_SESSION_EXPIRE', 1200))
+						self.vmware_sessions[tag] = (si, time.time())
+						return si
+			except Exception as e:
+				# Fall back to logging in again
+				syslog.syslog(syslog.LOG_WARNING, "Failed to use shared vCenter session for " + tag + ", logging in again: " + str(e))
+
+		si = SmartConnect(host=instance['hostname'], user=instance['user'], pwd=instance['pass'], port=instance['port'], sslContext=sslContext)
+
+		if share:
+			try:
+				self.rdb.setex(key, self.config.get('VMWARE_SESSION_EXPIRE', 1200), json.dumps({'cookie': si._stub.cookie, 'version': si._stub.version}))
+			except Exception as e:
+				syslog.syslog(syslog.LOG_WARNING, "Failed to share vCenter session for " + tag + ": " + str(e))
+
+		self.vmware_sessions[tag] = (si, time.time())
+		return si
 
 	################################################################################
 
@@ -701,6 +885,9 @@ class Corpus:
 
 		   If you want to customise the VM after cloning attach a customisation spec via the
 		   custspec optional parameter.
+
+		   Once the returned task has completed, call vmware_invalidate_obj_index so that
+		   vmware_get_obj can find the new VM.
 		"""
 
 		need_config_spec = False
@@ -962,6 +1149,9 @@ class Corpus:
 		# Commit
 		self.db.commit()
 
+		# Make sure the ENC isn't serving anything cached for the certname
+		self.puppet_enc_invalidate([certname])
+
 	############################################################################
 
 	def puppet_enc_remove(self, system_id):
@@ -970,12 +1160,33 @@ class Corpus:
 		# Get a cursor to the database
 		curd = self.db.cursor(mysql.cursors.DictCursor)
 
+		# Find the certname of the node, so we can invalidate its ENC document
+		curd.execute("SELECT `certname` FROM `puppet_nodes` WHERE `id` = %s", (system_id,))
+		certnames = [row['certname'] for row in curd.fetchall()]
+
 		# Delete the relevant row
 		curd.execute("DELETE FROM `puppet_nodes` WHERE `id` = %s", (system_id,))
 
 		# Commit
 		self.db.commit()
 
+		if certnames:
+			self.puppet_enc_invalidate(certnames)
+
+	############################################################################
+
+	def puppet_enc_invalidate(self, certnames=None):
+		"""Invalidates the ENC documents cached in Redis for the given list
+		of certnames, or for every node if certnames is None. See
+		cortex.lib.puppet.generate_node_config."""
+
+		try:
+			puppet_enc_cache.invalidate(self.rdb, certnames)
+		except Exception as e:
+			# The change has already been committed, so don't fail because of
+			# this - the cached documents will expire eventually
+			syslog.syslog(syslog.LOG_ERR, "Failed to invalidate Puppet ENC cache: " + str(e))
+
 	############################################################################
 
 	def vmware_vmreconfig_notes(self, vm, notes):
@@ -1106,6 +1317,9 @@ class Corpus:
 	def vmware_wait_for_powerstate(self, vm, powerstate, timeout=30):
 		"""Waits for a virtual machine to be marked as powerstate by VMware."""
 
+		# Write out any buffered task events before we start waiting
+		self._before_wait()
+
 		# Initialise our timer
 		timer = 0
 
@@ -1200,6 +1414,54 @@ class Corpus:
 
 	############################################################################
 
+	def vmware_collect_properties_by_type(self, service_instance, view_ref, path_sets):
+		"""
+		Collect properties for managed objects of several types from a view
+		ref in one go, rather than one call per object or per property.
+		Args:
+			service_instance (ServiceInstance): ServiceInstance connection
+			view_ref (pyVmomi.vim.view.*): Starting point of inventory navigation
+			path_sets (dict): Maps each type of managed object to the list of
+				properties to retrieve for it. If one type is a subclass
+				of another, objects are returned under the first type
+				they match, so list the more specific type first.
+		Returns:
+			A dictionary mapping each type to a dictionary, keyed by moId,
+			of the properties of each object. The properties also include
+			the managed object as 'obj' and its moId as '_moId'.
+		"""
+
+		# pylint: disable=protected-access
+		collector = service_instance.content.propertyCollector
+
+		filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+		filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=view_ref, skip=True, selectSet=[vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view', skip=False, type=view_ref.__class__)])]
+		filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set) for obj_type, path_set in path_sets.items()]
+
+		data = dict((obj_type, {}) for obj_type in path_sets)
+
+		# Retrieve properties, following on to the next page until we have
+		# everything
+		result = collector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions())
+		while result is not None:
+			for obj in result.objects:
+				properties = {'obj': obj.obj, '_moId': obj.obj._moId}
+				for prop in obj.propSet:
+					properties[prop.name] = prop.val
+
+				for obj_type in path_sets:
+					if isinstance(obj.obj, obj_type):
+						data[obj_type][obj.obj._moId] = properties
+						break
+
+			if result.token is None:
+				break
+			result = collector.ContinueRetrievePropertiesEx(result.token)
+
+		return data
+
+	############################################################################
+
 	def vmware_set_guestinfo_variable(self, vm, variable, value):
 		"""Sets a guestinfo variable that is accessible from VMware Tools
 		inside the VM. Returns the VMware task."""
@@ -1217,41 +1479,96 @@ class Corpus:
 	def vmware_wait_for_customisations(self, service_instance, vm, desired_status=2, timeout=300):
 		"""Waits for customisations"""
 
+		# Write out any buffered task events before we start waiting
+		self._before_wait()
+
 		# pylint: disable=invalid-name
 
 		# Build an event filter for the VM
 		filterSpec = vim.EventFilterSpec()
 		filterSpec.entity = vim.EventFilterSpecByEntity(entity=vm, recursion=vim.EventFilterSpecRecursionOption.self)
 
+		# Rather than querying the events over and over, create a collector for
+		# the VM's events and have vCenter tell us whenever its latest page of
+		# events changes. The first update contains the events so far.
+		event_collector = None
+		property_collector = None
+
 		# Initial status
 		status = 0
-		timer = 0
 
-		# Whilst we're not at our desired status, and we've not timed out...
-		while status != desired_status and timer < timeout:
-			# Query latest events
-			events = service_instance.content.eventManager.QueryEvents(filterSpec)
-
-			# Iterate over the events
-			for event in events:
-				# If the event is the one we're looking for the break out
-				if isinstance(event, vim.event.CustomizationStartedEvent) and desired_status == 1:
-					status = 1
-					break
-				if isinstance(event, vim.event.CustomizationSucceeded) and desired_status == 2:
-					status = 2
-					break
-
-			# Sleep brifly if we've not hit our status
-			if status != desired_status:
-				time.sleep(1)
-				timer = timer + 1
+		try:
+			event_collector = service_instance.content.eventManager.CreateCollectorForEvents(filterSpec)
+			event_collector.SetCollectorPageSize(100)
+			property_collector = service_instance.content.propertyCollector.CreatePropertyCollector()
+			property_collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+				objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=event_collector)],
+				propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.event.EventHistoryCollector, pathSet=['latestPage'])]
+			), True)
+
+			version = ''
+			deadline = time.time() + timeout
+
+			# Whilst we're not at our desired status, and we've not timed out...
+			while status != desired_status and time.time() < deadline:
+				version, changes = self.vmware_wait_for_property_changes(property_collector, version, deadline - time.time())
+
+				# Iterate over the events
+				for _obj, change in changes:
+					for event in change.val or []:
+						# If the event is the one we're looking for the break out
+						if isinstance(event, vim.event.CustomizationStartedEvent) and desired_status == 1:
+							status = 1
+							break
+						if isinstance(event, vim.event.CustomizationSucceeded) and desired_status == 2:
+							status = 2
+							break
+
+		finally:
+			# Destroy whichever collectors we managed to create, so that they
+			# don't pile up on the vCenter
+			try:
+				if property_collector is not None:
+					property_collector.Destroy()
+			finally:
+				if event_collector is not None:
+					event_collector.DestroyCollector()
 
 		# Return whether we reached the desired status or not (so return False on timeout)
 		return status == desired_status
 
 	############################################################################
 
+	def vmware_wait_for_property_changes(self, property_collector, version, timeout):
+		"""
+		Waits for up to timeout seconds for vCenter to report changes to the
+		properties being watched by the filters on a property collector.
+		Args:
+		   property_collector: The (preferably private) property collector
+		   version: The version returned by the last call, or '' initially
+		   timeout: The maximum number of seconds to wait
+		Returns:
+		   A tuple of the new version and a list of (managed object, change)
+		   tuples, which is empty if the timeout was reached.
+		"""
+
+		options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max(1, int(timeout)))
+		update_set = property_collector.WaitForUpdatesEx(version, options)
+
+		# None is returned when we time out without any changes
+		if update_set is None:
+			return version, []
+
+		changes = []
+		for filter_set in update_set.filterSet:
+			for object_set in filter_set.objectSet:
+				for change in object_set.changeSet:
+					changes.append((object_set.obj, change))
+
+		return update_set.version, changes
+
+	############################################################################
+
 	def vmware_get_container_view(self, service_instance, obj_type, container=None):
 		"""
 		Get a vSphere Container View reference to all objects of type 'obj_type'
@@ -1307,8 +1624,23 @@ class Corpus:
 		# Commit
 		self.db.commit()
 
+		# The CMDB link is included in the Puppet ENC document
+		if cmdb_id is not None:
+			cur.execute("SELECT `certname` FROM `puppet_nodes` WHERE `id` = %s", (cortex_system_id,))
+			certnames = [row['certname'] for row in cur.fetchall()]
+			if certnames:
+				self.puppet_enc_invalidate(certnames)
+
 	################################################################################
 
+	def servicenow_api(self):
+		"""Returns the ServiceNowAPI client for the configured ServiceNow
+		instance, which is shared by everything in this process"""
+
+		return ServiceNowAPI.shared(self.config)
+
+	############################################################################
+
 	def servicenow_link_task_to_ci(self, ci_sys_id, task_number):
 		"""Links a ServiceNow 'task' (Incident Task, Project Task, etc.) to a CI so that it appears in the related records.
 		   Note that you should NOT use this function to link an incident to a CI (even though ServiceNow will kind of let
@@ -1317,7 +1649,7 @@ class Corpus:
 		    - task_number: The task number (e.g. INCTASK0123456, PRJTASK0123456) to link to. NOT the sys_id of the task."""
 
 		# Request information about the task (incident task, project task, etc.) to get its sys_id
-		r = requests.get('https://' + self.config['SN_HOST'] + '/api/now/v1/table/task?sysparm_fields=sys_id&sysparm_query=number=' + task_number, auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json'})
+		r = self.servicenow_api().request('GET', '/api/now/v1/table/task?sysparm_fields=sys_id&sysparm_query=number=' + task_number, headers={'Accept': 'application/json'})
 
 		# Check we got a valid response
 		if r is not None and r.status_code >= 200 and r.status_code <= 299:
@@ -1335,7 +1667,7 @@ class Corpus:
 				raise Exception("Failed to query ServiceNow for task information. Invalid response from ServiceNow.")
 
 			# Make a post request to link the given CI to the task
-			r = requests.post('https://' + self.config['SN_HOST'] + '/api/now/v1/table/task_ci', auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json={'ci_item': ci_sys_id, 'task': task_sys_id})
+			r = self.servicenow_api().request('POST', '/api/now/v1/table/task_ci', headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json={'ci_item': ci_sys_id, 'task': task_sys_id})
 
 			# If we succeeded, return the sys_id of the link table entry
 			if r is not None and r.status_code >= 200 and r.status_code <= 299:
@@ -1420,7 +1752,7 @@ class Corpus:
 
 		# json= was only added in Requests 2.4.2, so might need to be data=json.dumps(vm_data)
 		# Content-Type header may be superfluous as Requests might add it anyway, due to json=
-		r = requests.post('https://' + self.config['SN_HOST'] + '/api/now/v1/table/' + table_name + "?sysparm_display_value=true", auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=vm_data)
+		r = self.servicenow_api().request('POST', '/api/now/v1/table/' + table_name + "?sysparm_display_value=true", headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=vm_data)
 
 		# Parse the response
 		if r is not None and r.status_code >= 200 and r.status_code <= 299:
@@ -1447,7 +1779,7 @@ class Corpus:
 	def servicenow_mark_ci_deleted(self, sys_id):
 		# Get the CI details. This checks that it exists and whether it's
 		# virtual or not
-		r = requests.get('https://' + self.config['SN_HOST'] + '/api/now/v1/table/cmdb_ci_server/' + sys_id, auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json'})
+		r = self.servicenow_api().request('GET', '/api/now/v1/table/cmdb_ci_server/' + sys_id, headers={'Accept': 'application/json'})
 
 		# Check we got a valid response
 		if r is not None:
@@ -1474,7 +1806,7 @@ class Corpus:
 			new_status = "Decommissioned"
 
 		# Update the operational_status field with the new status
-		r = requests.put('https://' + self.config['SN_HOST'] + '/api/now/v1/table/cmdb_ci_server/' + sys_id, auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json={'operational_status': new_status})
+		r = self.servicenow_api().request('PUT', '/api/now/v1/table/cmdb_ci_server/' + sys_id, headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json={'operational_status': new_status})
 
 		if r is not None:
 			if not r.status_code >= 200 and r.status_code <= 299:
@@ -1495,7 +1827,7 @@ class Corpus:
 		json_data = {'parent': parent_sys_id, 'child': child_sys_id, 'type': rel_type_sys_id}
 
 		# Post the request
-		r = requests.post('https://' + self.config['SN_HOST'] + '/api/now/v1/table/cmdb_rel_ci', auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=json_data)
+		r = self.servicenow_api().request('POST', '/api/now/v1/table/cmdb_rel_ci', headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=json_data)
 		if r is None:
 			raise Exception("Could not create CI relationship in ServiceNow. Request failed")
 
@@ -1513,7 +1845,7 @@ class Corpus:
 	def servicenow_get_ci_relationships(self, sys_id):
 		# Get the CI details. This checks that it exists and whether it's
 		# virtual or not
-		r = requests.get('https://' + self.config['SN_HOST'] + '/api/now/v1/table/cmdb_rel_ci?sysparm_query=child=' + sys_id + '^ORparent=' + sys_id, auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json'})
+		r = self.servicenow_api().request('GET', '/api/now/v1/table/cmdb_rel_ci?sysparm_query=child=' + sys_id + '^ORparent=' + sys_id, headers={'Accept': 'application/json'})
 
 		# Check we got a valid response code
 		if r is None:
@@ -1550,7 +1882,7 @@ class Corpus:
 		successes = 0
 		for entry in results:
 			try:
-				r = requests.delete('https://' + self.config['SN_HOST'] + '/api/now/v1/table/cmdb_rel_ci/' + entry['sys_id'], auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json'})
+				r = self.servicenow_api().request('DELETE', '/api/now/v1/table/cmdb_rel_ci/' + entry['sys_id'], headers={'Accept': 'application/json'})
 				if r is None or (r.status_code < 200 or r.status_code > 299):
 					warnings += 1
 				else:
@@ -1581,10 +1913,13 @@ class Corpus:
 			raise Exception("Failed to set_vm_data no UUID or VM provided")
 
 		if expire is not None:
-			self.rdb.setex("vm/" + uuid + "/" + key, expire, value)
+			self.rdb.setex("vm/" + uuid.lower() + "/" + key, expire, value)
 		else:
 			self.rdb.set("vm/" + uuid.lower() + "/" + key, value)
 
+		# Wake up anything waiting on this value (see wait_for_guest_notify)
+		self.rdb.publish("vm/" + uuid.lower() + "/" + key, value)
+
 	################################################################################
 
 	def redis_get_vm_data(self, key, vm=None, uuid=None):
@@ -1605,37 +1940,35 @@ class Corpus:
 	def wait_for_guest_notify(self, vm, states, timeout=28800):
 		"""Waits for the in-guest customisations to become one of the listed states."""
 
-		# Get the current state of the notify variable
-		notify = self.redis_get_vm_data('notify', vm=vm)
+		# Write out any buffered task events before we start waiting
+		self._before_wait()
 
-		# StrictRedis.get() returns bytes(), so decode it
-		if notify is not None:
-			if isinstance(notify, bytes):
-				notify = notify.decode('utf-8')
+		uuid = vm.config.uuid
 
-		# Start a timer
-		timer = 0
-
-		# Whilst we've not hit our timeout, and the installer hasn't set a
-		# notification value that is one of our states...
-		while timer < timeout:
-			# If we have a value for notify and the value is one of
-			# the states we are looking for...
-			if notify is not None and notify in states:
-				# ...escape the loop
-				break
-
-			# ...sleep and increment timer
-			time.sleep(1)
-			timer = timer + 1
+		# Changes to the notify variable are published by redis_set_vm_data, so
+		# subscribe to those before reading the current value so that nothing
+		# set in between is missed
+		pubsub = self.rdb.pubsub(ignore_subscribe_messages=True)
+		pubsub.subscribe("vm/" + uuid.lower() + "/notify")
 
-			# Get the lastest value of the notify
-			notify = self.redis_get_vm_data('notify', vm=vm)
+		try:
+			# Get the current state of the notify variable
+			notify = self.redis_get_vm_data('notify', uuid=uuid)
+			deadline = time.time() + timeout
+
+			# Whilst we've not hit our timeout, and the installer hasn't set a
+			# notification value that is one of our states...
+			while (notify is None or notify not in states) and time.time() < deadline:
+				# Sleep until the value is published, but check the value
+				# itself every so often in case it was set some other way
+				message = pubsub.get_message(timeout=min(60, deadline - time.time()))
+				if message is not None:
+					notify = message['data']
+				else:
+					notify = self.redis_get_vm_data('notify', uuid=uuid)
 
-			# StrictRedis.get() returns bytes(), so decode it
-			if notify is not None:
-				if isinstance(notify, bytes):
-					notify = notify.decode('utf-8')
+		finally:
+			pubsub.close()
 
 		# Return the latest value, which may be None if the in-guest installer
 		# never runs. Otherwise it can be any other value, which may not
@@ -1752,13 +2085,33 @@ class Corpus:
 	#######################################################################
 
 	def vmware_get_vm_by_uuid(self, uuid, vcenter):
-		"""Get a VM by UUID
+		"""Get a VM by UUID. The VM is found from its moId in the VMware
+		cache if possible, falling back to searching vCenter if the VM
+		isn't in the cache or the cache is out of date.
 		Args:
 		  uuid (string): UUID to find
 		  vcenter (string): vcenter to search in
 		Returns:
 		  VM if found or None otherwise"""
 
+		return self.vmware_get_vms_by_uuid([uuid], vcenter)[uuid]
+
+	############################################################################
+
+	def vmware_get_vms_by_uuid(self, uuids, vcenter):
+		"""Get several VMs on a vCenter by UUID, checking the VMs found from
+		the VMware cache in a single call. Any others (e.g. VMs built since
+		the cache was updated) are found with the search index, or if there
+		are more than VMWARE_UUID_SEARCH_MAX of them, by retrieving the UUID
+		of every VM on the vCenter in a single call.
+		Args:
+		  uuids (list): UUIDs to find
+		  vcenter (string): vcenter to search in
+		Returns:
+		  A dictionary mapping each UUID to the VM, or None if not found"""
+
+		# pylint: disable=protected-access
+
 		# Connect to the correct vCenter
 		instance = None
 		for key in self.config['VMWARE']:
@@ -1766,14 +2119,77 @@ class Corpus:
 				instance = key
 
 		# If we've found the right vCenter
-		if instance is not None:
-			# Connect
-			si = self.vmware_smartconnect(instance)
+		if instance is None:
+			raise Exception('VMware instance not found')
+
+		vms = dict((uuid, None) for uuid in uuids)
+		if not vms:
+			return vms
+
+		# Connect
+		si = self.vmware_smartconnect(instance)
+
+		## Look up the moIds of the VMs in the cache and build the objects
+		## directly from them
+		candidates = []
+		cur = self.db.cursor(mysql.cursors.DictCursor)
+		cur.execute("SELECT `id` FROM `vmware_cache_vm` WHERE `vcenter` = %s AND `uuid` IN (" + ", ".join(["%s"] * len(vms)) + ")", [vcenter] + list(vms.keys()))
+		for row in cur.fetchall():
+			candidates.append(vim.VirtualMachine(row['id'], si._stub))
+
+		## Check that the cache is right about each of them, ignoring any
+		## that have been deleted since the cache was updated
+		if candidates:
+			filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+				objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm) for vm in candidates],
+				propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=['config.uuid'])],
+				reportMissingObjectsInResults=True
+			)
+			self._vmware_match_uuids(si, filter_spec, vms)
+
+		## Use the search index for a few VMs that we couldn't find that way,
+		## as this is much cheaper than retrieving the UUID of every VM
+		missing = [uuid for uuid in vms if vms[uuid] is None]
+		if 0 < len(missing) <= self.config.get('VMWARE_UUID_SEARCH_MAX', 20):
 			content = si.RetrieveContent()
-			# Search for the VM by UUID
-			return content.searchIndex.FindByUuid(None, uuid, True, False)
+			for uuid in missing:
+				vms[uuid] = content.searchIndex.FindByUuid(None, uuid, True, False)
 
-		raise Exception('VMware instance not found')
+		## Otherwise search the whole vCenter for them
+		elif missing:
+			view = self.vmware_get_container_view(si, obj_type=[vim.VirtualMachine])
+			try:
+				filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+					objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view', skip=False, type=view.__class__)])],
+					propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=['config.uuid'])]
+				)
+				self._vmware_match_uuids(si, filter_spec, vms)
+			finally:
+				view.Destroy()
+
+		return vms
+
+	############################################################################
+
+	def _vmware_match_uuids(self, service_instance, filter_spec, vms):
+		"""Retrieves the UUID of every VM matched by the filter spec and puts
+		those VMs whose UUID is a key of vms (and not yet found) in to it"""
+
+		collector = service_instance.content.propertyCollector
+
+		# Compare case insensitively as we're given UUIDs in either case
+		wanted = dict((uuid.lower(), uuid) for uuid in vms if vms[uuid] is None)
+
+		result = collector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions())
+		while result is not None:
+			for obj in result.objects:
+				for prop in obj.propSet or []:
+					if prop.name == 'config.uuid' and prop.val is not None and prop.val.lower() in wanted:
+						vms[wanted[prop.val.lower()]] = obj.obj
+
+			if result.token is None:
+				break
+			result = collector.ContinueRetrievePropertiesEx(result.token)
 
 	############################################################################
 
@@ -1805,7 +2221,7 @@ class Corpus:
 			order_data['opened_by'] = opened_by
 
 		# Make an order to generate a request and request item
-		r = requests.post('https://' + self.config['SN_HOST'] + '/api/sn_sc/servicecatalog/items/' + request_type + '/order_now', auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=order_data)
+		r = self.servicenow_api().request('POST', '/api/sn_sc/servicecatalog/items/' + request_type + '/order_now', headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, json=order_data)
 		if r is not None and r.status_code == 200:
 			json_response = r.json()
 			request_id = json_response['result']['request_id']
@@ -1816,7 +2232,7 @@ class Corpus:
 			raise Exception(error)
 
 		# Get the sys_id of the request item for the request we just made
-		r = requests.get('https://' + self.config['SN_HOST'] + '/api/now/v1/table/sc_req_item?sysparm_query=request='  + request_id, auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
+		r = self.servicenow_api().request('GET', '/api/now/v1/table/sc_req_item?sysparm_query=request='  + request_id, headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
 		if r is not None and r.status_code == 200:
 			json_response = r.json()
 			req_item_id = json_response['result'][0]['sys_id']
@@ -1833,9 +2249,10 @@ class Corpus:
 		item_data['assignment_group'] = assignment_group
 
 		# Make a post request to ServiceNow to create the task
-		r = requests.put(
-			'https://' + self.config['SN_HOST'] + '/api/now/v1/table/sc_req_item/' + req_item_id,
-			auth=(self.config['SN_USER'], self.config['SN_PASS']), headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
+		r = self.servicenow_api().request(
+			'PUT',
+			'/api/now/v1/table/sc_req_item/' + req_item_id,
+			headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
 			json=item_data
 		)
 
@@ -1861,9 +2278,9 @@ class Corpus:
 		task_data['assignment_group'] = assignment_group
 
 		# Make a post request to ServiceNow to create the task
-		r = requests.post(
-			'https://' + self.config['SN_HOST'] + '/api/now/v1/table/incident',
-			auth=(self.config['SN_USER'], self.config['SN_PASS']),
+		r = self.servicenow_api().request(
+			'POST',
+			'/api/now/v1/table/incident',
 			headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
 			json=task_data
 		)
@@ -2028,17 +2445,35 @@ class Corpus:
 	def neocortex_task_wait(self, task):
 		"""Waits for a NeoCortex task to finish"""
 
-		while True:
-			# Get the task status
-			status = self.neocortex_task_get_status(task)
+		# Write out any buffered task events before we start waiting
+		self._before_wait()
 
-			# Status of zero is in-progress, so only break out and
-			# return the status when we're not that
-			if status is not None and int(status) != 0:
-				return status
+		# Tasks publish a record on their event channel when they start and
+		# end, so wait on that rather than polling the database
+		channel = 'task/' + str(task) + '/events'
+		pubsub = self.rdb.pubsub(ignore_subscribe_messages=True)
+		pubsub.subscribe(channel)
 
-			## Let's not busy wait CPU 100%...
-			time.sleep(1)
+		try:
+			while True:
+				# Get the task status
+				status = self.neocortex_task_get_status(task)
+
+				# Status of zero is in-progress and five is queued, so only
+				# break out and return the status when we're not either
+				if status is not None and int(status) not in (0, 5):
+					return status
+
+				# Wait for the task to start or end, checking the database
+				# every so often in case that is never published
+				deadline = time.time() + 60
+				while time.time() < deadline:
+					message = pubsub.get_message(timeout=deadline - time.time())
+					if message is not None and json.loads(message['data'])['action'] == 'task':
+						break
+
+		finally:
+			pubsub.close()
 
 	############################################################################
 
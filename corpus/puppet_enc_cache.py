@@ -0,0 +1,164 @@
+import time
+
+import redis
+
+# Generated Puppet ENC documents (see cortex.lib.puppet.generate_node_config)
+# are cached in Redis. Each cached value is stored as the version of its
+# inputs when it was generated, a newline and then the value. The version is
+# made up of a generation counter for the whole cache and, for documents, a
+# counter for the node, which are incremented by invalidate(). A value which
+# was generated whilst its inputs were being changed is therefore stored
+# with an old version and never used.
+GENERATION_KEY = 'puppet/enc/generation'
+DEFAULT_CLASSES_KEY = 'puppet/enc/default'
+NODE_KEY_PREFIX = 'puppet/enc/node/'
+
+# The times at which each node was last invalidated, at which the whole
+# cache was last invalidated, and from which the times of each node are
+# complete, i.e. nothing newer has been pruned (see changed_since)
+CHANGED_KEY = 'puppet/enc/changed'
+INVALIDATED_KEY = 'puppet/enc/invalidated'
+CHANGED_SINCE_KEY = 'puppet/enc/changed/since'
+
+def node_key(certname):
+	"""Returns the key of the cached document of a node"""
+
+	return NODE_KEY_PREFIX + certname
+
+def node_generation_key(certname):
+	"""Returns the key of the generation counter of a node"""
+
+	return NODE_KEY_PREFIX + certname + '/gen'
+
+################################################################################
+
+def _get(rdb, key, generation_keys):
+	"""Gets a cached value, returning a tuple of the current version of its
+	inputs and the value, which is None if there is no value or it was
+	generated from an older version of its inputs."""
+
+	values = rdb.mget(generation_keys + [key])
+	version = ':'.join(generation or '0' for generation in values[:-1])
+
+	if values[-1] is not None:
+		cached_version, value = values[-1].split('\n', 1)
+		if cached_version == version:
+			return version, value
+
+	return version, None
+
+def _set(rdb, key, version, value, expire):
+	"""Stores a value which was generated from the given version of its
+	inputs, as returned by _get"""
+
+	rdb.setex(key, expire, version + '\n' + value)
+
+################################################################################
+
+def get_node(rdb, certname):
+	"""Gets the cached ENC document of a node. Returns a tuple of the
+	current version of the node's inputs (to pass to set_node) and the
+	document, or None if it isn't cached."""
+
+	return _get(rdb, node_key(certname), [GENERATION_KEY, node_generation_key(certname)])
+
+def set_node(rdb, certname, version, document, expire):
+	"""Caches the ENC document of a node, generated from the version of its
+	inputs returned by get_node before it was generated"""
+
+	_set(rdb, node_key(certname), version, document, expire)
+
+def get_default_classes(rdb):
+	"""Gets the cached default classes (as JSON), in the same way as
+	get_node"""
+
+	return _get(rdb, DEFAULT_CLASSES_KEY, [GENERATION_KEY])
+
+def set_default_classes(rdb, version, default_classes, expire):
+	"""Caches the default classes (as JSON), in the same way as set_node"""
+
+	_set(rdb, DEFAULT_CLASSES_KEY, version, default_classes, expire)
+
+################################################################################
+
+def invalidate(rdb, certnames=None):
+	"""Invalidates the cached ENC documents of the given certnames, or of
+	every node (and the default classes) if certnames is None. This must
+	be called after committing any change to the data that the documents
+	are generated from. The time of the change is recorded for
+	changed_since."""
+
+	now = time.time()
+	pipe = rdb.pipeline()
+	if certnames is None:
+		pipe.incr(GENERATION_KEY)
+		pipe.set(INVALIDATED_KEY, now)
+
+		# Every node has changed now, so there's no need to remember which
+		# of them changed before
+		pipe.delete(CHANGED_KEY)
+		pipe.set(CHANGED_SINCE_KEY, now)
+	else:
+		for certname in certnames:
+			pipe.incr(node_generation_key(certname))
+			pipe.delete(node_key(certname))
+			pipe.hset(CHANGED_KEY, certname, now)
+	pipe.execute()
+
+################################################################################
+
+def changed_since(rdb, since):
+	"""Returns the set of certnames whose ENC documents may have changed
+	since the given time (as a UNIX timestamp), or None if every document
+	may have changed (e.g. the default classes have changed since then)."""
+
+	pipe = rdb.pipeline()
+	pipe.get(INVALIDATED_KEY)
+	pipe.get(CHANGED_SINCE_KEY)
+	pipe.hgetall(CHANGED_KEY)
+	invalidated, changed_from, changed = pipe.execute()
+
+	# If we don't know when everything was last invalidated (e.g. Redis has
+	# been flushed, or nothing has been invalidated yet) we can't tell what
+	# has changed. Start keeping track from now, so that we can next time.
+	if invalidated is None:
+		now = time.time()
+		pipe = rdb.pipeline()
+		pipe.setnx(INVALIDATED_KEY, now)
+		pipe.setnx(CHANGED_SINCE_KEY, now)
+		pipe.execute()
+		return None
+
+	# Likewise if everything has changed since then, or if changes from that
+	# long ago have been pruned
+	if float(invalidated) >= since:
+		return None
+	if changed_from is not None and float(changed_from) > since:
+		return None
+
+	return set(certname for certname, changed_at in changed.items() if float(changed_at) >= since)
+
+def prune_changes(rdb, retention):
+	"""Forgets the times at which nodes were invalidated that are more than
+	retention seconds ago, so that the record of changes doesn't grow
+	forever. changed_since returns None for times before that."""
+
+	cutoff = time.time() - retention
+	with rdb.pipeline() as pipe:
+		while True:
+			try:
+				pipe.watch(CHANGED_KEY, CHANGED_SINCE_KEY)
+				old = [certname for certname, changed_at in pipe.hgetall(CHANGED_KEY).items() if float(changed_at) < cutoff]
+				if not old:
+					pipe.unwatch()
+					return
+
+				changed_from = pipe.get(CHANGED_SINCE_KEY)
+				pipe.multi()
+				pipe.hdel(CHANGED_KEY, *old)
+				pipe.set(CHANGED_SINCE_KEY, max(cutoff, float(changed_from or 0)))
+				pipe.execute()
+				return
+			except redis.WatchError:
+				# Someone else changed the record, so try again
+				continue
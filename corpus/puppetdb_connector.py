@@ -1,5 +1,8 @@
 import pypuppetdb
 
+# The fields of each node that are kept in the snapshot of node statuses
+# (see neocortex/cache_puppetdb.py and cortex.lib.puppet)
+NODE_FIELDS = ["certname", "report_environment", "report_timestamp", "latest_report_status", "latest_report_noop", "latest_report_noop_pending", "latest_report_hash"]
 
 class PuppetDBConnector:
 
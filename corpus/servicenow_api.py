@@ -0,0 +1,150 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RateLimiter:
+	"""A token bucket which allows rate requests per second on average, with
+	bursts of up to burst requests, shared between threads"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = float(burst if burst is not None else max(1, rate))
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		"""Waits until a request may be made"""
+
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
+
+			time.sleep(wait)
+
+class ServiceNowAPI():
+	"""A client for the ServiceNow REST API. Requests are made over a pooled
+	keep-alive session with timeouts, and are retried with backoff when
+	ServiceNow returns 429 or a 5xx error (except POSTs, which are never
+	retried as they may not be safe to repeat). Requests can be rate limited,
+	and submit() runs work on a bounded pool of threads."""
+
+	## Clients shared by everything in a process, see shared()
+	_shared = {}
+	_shared_lock = threading.Lock()
+
+	# pylint: disable=too-many-arguments
+	def __init__(self, host, version, username, password, timeout=60, connect_timeout=10, retries=3, backoff=0.5, rate_limit=0, workers=4):
+		self.host = host
+		self.version = version
+		self.username = username
+		self.password = password
+		self.timeout = (connect_timeout, timeout)
+		self.workers = workers
+
+		# The threads are only started as work is submitted
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		self.limiter = RateLimiter(rate_limit) if rate_limit else None
+
+		retry_args = {'total': retries, 'backoff_factor': backoff, 'status_forcelist': [429, 500, 502, 503, 504], 'raise_on_status': False}
+		retry_methods = frozenset(['HEAD', 'GET', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+		try:
+			retry = Retry(allowed_methods=retry_methods, **retry_args)
+		except TypeError:
+			# urllib3 before 1.26 calls this method_whitelist
+			retry = Retry(method_whitelist=retry_methods, **retry_args)
+
+		self.session = requests.Session()
+		self.session.auth = (username, password)
+		self.session.headers.update({"Accept": "application/json"})
+		self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(10, workers), max_retries=retry))
+
+	@classmethod
+	def shared(cls, config, version='v1'):
+		"""Returns a client for the ServiceNow instance in the configuration
+		which is shared by everything in this process, so that connections
+		and the rate limit are shared too"""
+
+		key = (os.getpid(), config['SN_HOST'], config['SN_USER'], version)
+		with cls._shared_lock:
+			if key not in cls._shared:
+				cls._shared[key] = cls(
+					config['SN_HOST'], version, config['SN_USER'], config['SN_PASS'],
+					timeout=config.get('SN_API_TIMEOUT', 60),
+					connect_timeout=config.get('SN_API_CONNECT_TIMEOUT', 10),
+					retries=config.get('SN_API_RETRIES', 3),
+					backoff=config.get('SN_API_BACKOFF', 0.5),
+					rate_limit=config.get('SN_API_RATE_LIMIT', 0),
+					workers=config.get('SN_API_WORKERS', 4),
+				)
+
+			return cls._shared[key]
+
+	def request(self, method, path, **kwargs):
+		"""Makes a request to ServiceNow, where path is either a full URL or
+		a path on the instance (e.g. /api/now/v1/table/incident), returning
+		the response. Unlike the other methods this doesn't raise an
+		exception for HTTP errors."""
+
+		if not path.startswith("https://"):
+			path = "https://" + self.host + path
+
+		kwargs.setdefault('timeout', self.timeout)
+
+		if self.limiter is not None:
+			self.limiter.acquire()
+
+		return self.session.request(method, path, **kwargs)
+
+	def submit(self, fn, *args, **kwargs):
+		"""Runs fn on the client's pool of threads, returning a Future"""
+
+		return self.executor.submit(fn, *args, **kwargs)
+
+	def get_table(self, table, **kwargs):
+
+		response = self.request("GET", "/api/now/" + self.version + "/table/" + table, params=kwargs)
+		response.raise_for_status()
+
+		return response.json()
+
+	def get(self, table, sys_id):
+		headers = {"Content-Type":"application/json", "Accept":"application/json"}
+		response = self.request("GET", "/api/now/" + self.version + "/table/" + table + "/" + sys_id, headers=headers)
+
+		response.raise_for_status()
+
+		return response.json()
+
+	def put(self, table, sys_id, data):
+
+		headers = {"Content-Type":"application/json", "Accept":"application/json"}
+		response = self.request("PUT", "/api/now/" + self.version + "/table/" + table + "/" + sys_id, headers=headers, data=json.dumps(data))
+
+		response.raise_for_status()
+
+		return response.json()
+
+	def post(self, table, data):
+
+		headers = {"Content-Type":"application/json", "Accept":"application/json"}
+		response = self.request("POST", "/api/now/" + self.version + "/table/" + table, headers=headers, data=json.dumps(data))
+
+		response.raise_for_status()
+
+		return response.json()
@@ -1,9 +1,11 @@
+import hashlib
 import json
 import syslog
 
-import requests
 from requests.exceptions import HTTPError
 
+from .servicenow_api import ServiceNowAPI
+
 class SNPuppetConnector:
 
 	# Table Definitions
@@ -12,22 +14,86 @@ class SNPuppetConnector:
 	FILESYSTEMS_TABLE = "cmdb_ci_file_system"
 	NETWORK_ADAPTER_TABLE = "cmdb_ci_network_adapter"
 
-	def __init__(self, sn_host, sn_version, sn_user, sn_pass, puppet_connector):
-		# Create the ServiceNowAPI / PuppetDB Objects.
-		self.service_now = ServiceNowAPI(sn_host, sn_version, sn_user, sn_pass)
+	def __init__(self, sn_host, sn_version, sn_user, sn_pass, puppet_connector, rdb=None, fingerprint_expire=604800, service_now=None):
+		# Create the ServiceNowAPI / PuppetDB Objects, unless we're given an
+		# existing (e.g. shared) ServiceNowAPI object to use
+		if service_now is None:
+			service_now = ServiceNowAPI(sn_host, sn_version, sn_user, sn_pass)
+		self.service_now = service_now
 		self.puppet = puppet_connector
 
+		# If given a Redis connection, we keep a fingerprint of what was last
+		# pushed for each record of each CI, so we only push what has changed.
+		# Fingerprints expire so that everything is pushed again eventually.
+		self.rdb = rdb
+		self.fingerprint_expire = fingerprint_expire
+		self.fingerprints = {}
+		self.seen_fingerprints = {}
+		self.pushed = 0
+
 	def push_facts(self, node, cmdb_id, **kwargs):
 		"""
 		Push facts from Puppet to ServiceNow
 		Args:
 			cmbd_id - ServiceNow Sys ID
+		Returns:
+			The number of records that were sent to ServiceNow, which is
+			zero if nothing has changed since they were last pushed
+		"""
+
+		key = 'sn/puppet/fingerprints/' + cmdb_id
+		self.fingerprints = {}
+		self.seen_fingerprints = {}
+		self.pushed = 0
+
+		if self.rdb is not None:
+			try:
+				self.fingerprints = self.rdb.hgetall(key)
+			except Exception as e:
+				syslog.syslog("Could not get fact fingerprints for %s. Error: %s" %(node.name, str(e)))
+
+		try:
+			self.push_server_facts(node, cmdb_id, **kwargs)
+			self.push_networking_facts(node, cmdb_id, **kwargs)
+			self.push_disk_facts(node, cmdb_id, **kwargs)
+			self.push_mountpoint_facts(node, cmdb_id, **kwargs)
+		finally:
+			# Save the fingerprints of what is now in ServiceNow (even if we
+			# failed part way through), forgetting records that have gone
+			if self.rdb is not None and self.seen_fingerprints != self.fingerprints:
+				try:
+					pipe = self.rdb.pipeline()
+					pipe.delete(key)
+					if self.seen_fingerprints:
+						pipe.hset(key, mapping=self.seen_fingerprints)
+						pipe.expire(key, self.fingerprint_expire)
+					pipe.execute()
+				except Exception as e:
+					syslog.syslog("Could not save fact fingerprints for %s. Error: %s" %(node.name, str(e)))
+
+		return self.pushed
+
+	def _unchanged(self, record, data):
+		"""
+		Returns True if the data for a record (e.g. a disk) of the CI is
+		the same as what was last pushed to ServiceNow. Otherwise returns
+		False, and the record should then be pushed and _pushed called.
+		"""
+
+		fingerprint = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+		if self.fingerprints.get(record) == fingerprint:
+			self.seen_fingerprints[record] = fingerprint
+			return True
+
+		return False
+
+	def _pushed(self, record, data):
+		"""
+		Records that the data for a record of the CI has been pushed
 		"""
 
-		self.push_server_facts(node, cmdb_id, **kwargs)
-		self.push_networking_facts(node, cmdb_id, **kwargs)
-		self.push_disk_facts(node, cmdb_id, **kwargs)
-		self.push_mountpoint_facts(node, cmdb_id, **kwargs)
+		self.seen_fingerprints[record] = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+		self.pushed += 1
 
 	def push_server_facts(self, node, node_sys_id, **kwargs):
 		"""
@@ -57,12 +123,17 @@ class SNPuppetConnector:
 			if ram is not None:
 				sn_server_data["ram"] = ram
 
+			if self._unchanged('server', sn_server_data):
+				return
+
 			try:
 				self.service_now.put(self.LINUX_SERVER_TABLE, node_sys_id, data=sn_server_data)
 			except HTTPError as e:
 				syslog.syslog("Could not update %s. Error: %s" %(node.name, str(e)))
 				raise
 
+			self._pushed('server', sn_server_data)
+
 		except KeyError as e:
 			syslog.syslog("Error adding server data. Error: %s" %(str(e)))
 			raise
@@ -88,6 +159,9 @@ class SNPuppetConnector:
 				if "netmask" in interface_data:
 					sn_interface_data["netmask"] = interface_data["netmask"]
 
+				if self._unchanged('interface/' + interface_name, sn_interface_data):
+					continue
+
 				try:
 					adapter_response = self.service_now.get_table(
 						self.NETWORK_ADAPTER_TABLE,
@@ -114,6 +188,8 @@ class SNPuppetConnector:
 						syslog.syslog("Could not update interface %s. Error: %s" %(interface_name, str(e)))
 						raise
 
+				self._pushed('interface/' + interface_name, sn_interface_data)
+
 		except KeyError as e:
 			syslog.syslog("Error adding network interfaces. Error: %s" %(str(e)))
 			raise
@@ -135,6 +211,10 @@ class SNPuppetConnector:
 				sn_disk_data["size_bytes"] = disk_data["size_bytes"]
 				sn_disk_data["install_status"] = "1"
 				sn_disk_data["disk_space"] = "%.2f"%(float(disk_data["size_bytes"])/1024**3)
+
+				if self._unchanged('disk/' + disk_name, sn_disk_data):
+					continue
+
 				try:
 					disk_response = self.service_now.get_table(self.DISKS_TABLE, sysparm_query='computer=%s^name=%s'%(node_sys_id, disk_name))
 				except HTTPError as e:
@@ -158,6 +238,8 @@ class SNPuppetConnector:
 					except HTTPError as e:
 						syslog.syslog("Could not update disk %s. Error: %s" %(disk_name, str(e)))
 						raise
+
+				self._pushed('disk/' + disk_name, sn_disk_data)
 		except KeyError:
 			syslog.syslog("Error adding disks. Error: %s" %(str(e)))
 			raise
@@ -183,6 +265,9 @@ class SNPuppetConnector:
 				sn_mountpoint_data["free_space_bytes"] = mountpoint_data["available_bytes"]
 				sn_mountpoint_data["file_system"] = mountpoint_data["filesystem"]
 
+				if self._unchanged('mountpoint/' + mountpoint_name, sn_mountpoint_data):
+					continue
+
 				try:
 					mountpoint_response = self.service_now.get_table(self.FILESYSTEMS_TABLE, sysparm_query='computer=%s^name=%s'%(node_sys_id, mountpoint_name))
 				except HTTPError as e:
@@ -206,60 +291,8 @@ class SNPuppetConnector:
 					except HTTPError as e:
 						syslog.syslog("Could not update mountpoint %s. Error: %s" %(mountpoint_name, str(e)))
 						raise
+
+				self._pushed('mountpoint/' + mountpoint_name, sn_mountpoint_data)
 		except KeyError:
 			syslog.syslog("Error adding mountpoints. Error: %s" %(str(e)))
 			raise
-
-
-class ServiceNowAPI():
-
-	def __init__(self, host, version, username, password):
-		self.host = host
-		self.version = version
-		self.username = username
-		self.password = password
-
-	def get_table(self, table, **kwargs):
-
-		url = "https://" + self.host + "/api/now/" + self.version + "/table/" + table
-
-		if kwargs:
-			url = url + "?"
-			# Add keyword arguments to the url.
-			for key, value in kwargs.items():
-				url = url + str(key) + "=" + str(value) + "&"
-			url = url.strip('&')
-
-		response = requests.get(url, auth=(self.username, self.password), headers={"Accept":"application/json"})
-		response.raise_for_status()
-
-		return response.json()
-
-	def get(self, table, sys_id):
-		url = "https://" + self.host + "/api/now/" + self.version + "/table/" + table + "/" + sys_id
-		headers = {"Content-Type":"application/json", "Accept":"application/json"}
-		response = requests.get(url, auth=(self.username, self.password), headers=headers)
-
-		response.raise_for_status()
-
-		return response.json()
-
-	def put(self, table, sys_id, data):
-
-		url = "https://" + self.host + "/api/now/" + self.version + "/table/" + table + "/" + sys_id
-		headers = {"Content-Type":"application/json", "Accept":"application/json"}
-		response = requests.put(url, auth=(self.username, self.password), headers=headers, data=json.dumps(data))
-
-		response.raise_for_status()
-
-		return response.json()
-
-	def post(self, table, data):
-
-		url = "https://" + self.host + "/api/now/" + self.version + "/table/" + table
-		headers = {"Content-Type":"application/json", "Accept":"application/json"}
-		response = requests.post(url, auth=(self.username, self.password), headers=headers, data=json.dumps(data))
-
-		response.raise_for_status()
-
-		return response.json()
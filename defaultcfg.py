@@ -72,10 +72,67 @@ SN_PASS = ''
 CMDB_URL_FORMAT = 'https://myinstance.service-now.com/nav_to.do?uri=cmdb_ci_server.do?sys_id=%s'
 CMDB_CACHED_CLASSES = {'cmdb_ci_server': 'Server'}
 
+# Requests to ServiceNow time out after SN_API_CONNECT_TIMEOUT seconds waiting
+# to connect or SN_API_TIMEOUT seconds waiting for a response, and are retried
+# up to SN_API_RETRIES times (with exponential backoff starting at SN_API_BACKOFF
+# seconds) if ServiceNow returns 429 or a 5xx error. SN_API_RATE_LIMIT limits
+# the requests per second made by each process (0 for no limit), and tasks that
+# make requests in parallel make at most SN_API_WORKERS at once.
+SN_API_TIMEOUT = 60
+SN_API_CONNECT_TIMEOUT = 10
+SN_API_RETRIES = 3
+SN_API_BACKOFF = 0.5
+SN_API_RATE_LIMIT = 0
+SN_API_WORKERS = 4
+
+# How many CIs to download from ServiceNow per request when updating the CMDB
+# cache
+SN_CACHE_PAGE_SIZE = 1000
+
+# How many CIs to write to the CMDB cache per INSERT statement
+SN_CACHE_INSERT_CHUNK = 500
+
+# When the CMDB cache is updated incrementally (bin/update_servicenow_cache
+# --incremental) only CIs updated since this many seconds before the newest
+# change seen last time are downloaded. The whole cache is reloaded instead if
+# it hasn't been for SN_CACHE_FULL_INTERVAL seconds, which also removes CIs
+# that have been deleted from ServiceNow.
+SN_CACHE_WATERMARK_OVERLAP = 300
+SN_CACHE_FULL_INTERVAL = 86400
+
+# How long in seconds to remember what facts were pushed from Puppet to each
+# CI in ServiceNow. Only facts that have changed are pushed until this expires.
+SN_PUPPET_FINGERPRINT_EXPIRE = 604800
+
 # VMware configuration
 VMWARE = {}
 VMWARE_CACHE_UPDATE_TIMEOUT = 1800
 
+# How long the VMware cache sync task (bin/sync_vmware_cache) applies changes
+# from VMware for before it ends, and how long in seconds it waits for changes
+# from each vCenter in turn
+VMWARE_CACHE_SYNC_DURATION = 3600
+VMWARE_CACHE_SYNC_WAIT = 2
+
+# How long in seconds the index of VMware objects by name used when looking
+# up templates, datacenters, clusters etc. is kept before being rebuilt
+VMWARE_OBJ_INDEX_TTL = 300
+
+# When looking up VMs by UUID, the search index is used for VMs which aren't
+# in the VMware cache. If more VMs than this are missing from the cache, the
+# UUID of every VM on the vCenter is retrieved in one call instead.
+VMWARE_UUID_SEARCH_MAX = 20
+
+# Share logged in vCenter sessions between tasks and web requests by keeping
+# their session cookies in Redis, rather than logging in to vCenter every time.
+# The shared session is forgotten after VMWARE_SESSION_EXPIRE seconds unused,
+# which should be less than the session timeout on the vCenter (30 minutes by
+# default). Note that the cookies are stored in plain text (under
+# vmware/session/<tag>) and give the access of the configured vCenter user to
+# anyone who can read Redis, so only enable this if Redis is suitably secured.
+VMWARE_SESSION_SHARE = False
+VMWARE_SESSION_EXPIRE = 1200
+
 # Do not raise exceptions if Cortex cannot talk to the vCenter
 HANDLE_UNAVAILABLE_VCENTER_GRACEFULLY = True
 
@@ -86,12 +143,76 @@ NEOCORTEX_SET_UID = 'nginx'
 WORKFLOWS_DIR = '/data/cortex/workflows/'
 NEOCORTEX_TASKS_DIR = '/data/cortex/cortex/neocortex'
 
+# The maximum number of tasks neocortex will run at once. Tasks submitted
+# whilst all the workers are busy are queued until one becomes free.
+NEOCORTEX_MAX_WORKERS = 16
+
+# Per-workflow / per-task limits on the number of concurrent instances, e.g.
+# {'buildvm': 4, 'decom': 2}. Names not listed are only limited by
+# NEOCORTEX_MAX_WORKERS.
+NEOCORTEX_WORKFLOW_CONCURRENCY = {}
+
+# Number of workers that tasks started by the scheduler (i.e. the bin/ cron
+# jobs) may not use, so that they are always free for interactive tasks
+NEOCORTEX_RESERVED_INTERACTIVE_WORKERS = 4
+
+# Queued tasks are started highest priority first. By default workflows are
+# 20, internal tasks started by a user are 10 and scheduled jobs are 0. These
+# can be overridden per workflow / task name, e.g. {'_cert_scan': -10}
+NEOCORTEX_TASK_PRIORITIES = {}
+
+# The minimum number of seconds between checks for finished tasks and queued
+# tasks which can be started, as well as whenever a task is submitted
+NEOCORTEX_DISPATCH_INTERVAL = 1
+
+# Running tasks hold a lease on the task queue which they renew in the
+# background. If the lease runs out (seconds) the worker is assumed lost.
+NEOCORTEX_TASK_LEASE = 120
+
+# Tasks which are safe to run again from the start if their worker is lost
+# or neocortex is restarted, and how many times to try them, e.g.
+# ['_cache_vmware', '_cache_servicenow', '_puppet_nodes_status']. Anything
+# else is marked as failed. Tasks still waiting on the queue are always kept.
+NEOCORTEX_RETRYABLE_TASKS = []
+NEOCORTEX_TASK_MAX_ATTEMPTS = 3
+
+# Modules imported by neocortex at startup so that task workers, which are
+# forked from it, don't each pay the cost of importing them, e.g.
+# ['pyVmomi', 'OpenSSL', 'f5.bigip']. Workflow task modules (and whatever
+# they import) are always preloaded.
+NEOCORTEX_PRELOAD_MODULES = []
+
+# Task events are buffered and written to the database in batches once
+# there are this many changes waiting or the oldest is this many seconds old
+NEOCORTEX_EVENT_FLUSH_SIZE = 50
+NEOCORTEX_EVENT_FLUSH_INTERVAL = 5
+
+# Tasks publish their events to Redis so that the task status page can stream
+# them live rather than polling. The events are kept in Redis for this many
+# seconds after the last one, and each stream is closed (and the browser
+# reconnects, carrying on where it left off) after at most this many seconds.
+# Each open stream ties up a web server worker (or thread), so at most
+# TASK_EVENT_STREAM_MAX_STREAMS are open at once across all workers; beyond
+# that, task status pages poll instead. Keep this well below the number of
+# workers.
+TASK_EVENT_STREAM = True
+TASK_EVENT_STREAM_EXPIRE = 86400
+TASK_EVENT_STREAM_MAX_DURATION = 300
+TASK_EVENT_STREAM_MAX_STREAMS = 20
+
 # Other
 ENVIRONMENTS = []
 
 ## API pre-shared keys
 # used by puppet master to get ENC data
 ENC_API_AUTH_TOKEN = 'changeme'
+# How long (in seconds) generated ENC documents are cached in Redis for. The
+# cache is invalidated whenever Cortex changes the data they're generated from
+PUPPET_ENC_CACHE_EXPIRE = 3600
+# How long (in seconds) to remember which ENC documents have changed for the
+# ENC export API. Clients asking for changes over a longer period than this
+# are sent every document.
+PUPPET_ENC_CHANGES_RETENTION = 86400
 # used by all other API calls
 CORTEX_API_AUTH_TOKEN = 'changeme'
 
@@ -102,6 +223,11 @@ PUPPETDB_SSL_VERIFY = False
 PUPPETDB_SSL_CERT = ''
 PUPPETDB_SSL_KEY = ''
 
+# How long (in seconds) the snapshot of node statuses kept in Redis by
+# bin/cache_puppetdb is used for, after which the web views go back to
+# querying PuppetDB directly. Run bin/cache_puppetdb more often than this.
+PUPPETDB_SNAPSHOT_EXPIRE = 600
+
 # Cortex Puppet Bridge (Puppet autosign server)
 PUPPET_MASTER = 'puppet.yourdomain.tld'
 PUPPET_AUTOSIGN_URL = 'https://yourserver.tld/getcert'
@@ -1,5 +1,8 @@
 
+import json
 import re
+import time
+import uuid
 
 import MySQLdb as mysql
 import Pyro4
@@ -193,6 +196,16 @@ def task_get(task_id):
 
 ################################################################################
 
+# Task statuses which mean the task hasn't finished yet (in progress, queued)
+TASK_PENDING_STATUSES = (0, 5)
+
+def task_is_pending(task):
+	"""Returns True if the task is queued or still running"""
+
+	return task['status'] in TASK_PENDING_STATUSES
+
+################################################################################
+
 def task_render_status(task, template, hide_success=False):
 	# Get the events for the task
 	curd = g.db.cursor(mysql.cursors.DictCursor)
@@ -203,6 +216,110 @@ def task_render_status(task, template, hide_success=False):
 
 ################################################################################
 
+def _task_event_message(seq, data):
+	"""Formats a published task event record as a Server-Sent Event"""
+
+	record = json.loads(data)
+	record['seq'] = seq
+	if 'desc' in record:
+		record['desc_html'] = str(app.parse_cortex_links(record['desc']))
+
+	return "id: " + str(seq) + "\nevent: " + record['action'] + "\ndata: " + json.dumps(record) + "\n\n"
+
+# The streams currently open (see task_event_stream_acquire), as a sorted set
+# of tokens scored by when they expire
+TASK_EVENT_STREAMS_KEY = 'task/streams'
+
+def task_event_stream_acquire():
+	"""Reserves one of the TASK_EVENT_STREAM_MAX_STREAMS task event streams
+	that may be open at once, returning a token to pass to
+	task_event_stream_release, or None if they are all in use. Reservations
+	expire shortly after the longest a stream can last, so any not released
+	(e.g. because the process was killed) are eventually freed."""
+
+	token = str(uuid.uuid4())
+	now = time.time()
+
+	pipe = g.redis.pipeline()
+	pipe.zremrangebyscore(TASK_EVENT_STREAMS_KEY, '-inf', now)
+	pipe.zadd(TASK_EVENT_STREAMS_KEY, {token: now + app.config['TASK_EVENT_STREAM_MAX_DURATION'] + 60})
+	pipe.zcard(TASK_EVENT_STREAMS_KEY)
+	streams = pipe.execute()[2]
+
+	if streams > app.config['TASK_EVENT_STREAM_MAX_STREAMS']:
+		g.redis.zrem(TASK_EVENT_STREAMS_KEY, token)
+		return None
+
+	return token
+
+def task_event_stream_release(rdb, token):
+	"""Releases a task event stream reserved by task_event_stream_acquire"""
+
+	rdb.zrem(TASK_EVENT_STREAMS_KEY, token)
+
+################################################################################
+
+def task_event_stream(task, last_event_id=-1):
+	"""A generator which yields the events of a task, as published to Redis by
+	neocortex, formatted as Server-Sent Events. Starts with those published
+	after last_event_id and then follows the task's channel until the task
+	finishes or TASK_EVENT_STREAM_MAX_DURATION is reached."""
+
+	key = 'task/' + str(task['id']) + '/events'
+
+	# Subscribe before catching up so that nothing published in between is missed
+	pubsub = g.redis.pubsub(ignore_subscribe_messages=True)
+	pubsub.subscribe(key)
+
+	try:
+		task_status = None
+
+		# Catch up on everything published before we subscribed
+		for data in g.redis.lrange(key, last_event_id + 1, -1):
+			last_event_id = last_event_id + 1
+			yield _task_event_message(last_event_id, data)
+
+			record = json.loads(data)
+			if record['action'] == 'task':
+				task_status = record['status']
+
+		if not task_is_pending(task) and task_status in (None,) + TASK_PENDING_STATUSES:
+			# The end of the task was never published (e.g. it finished
+			# before its events were kept in Redis) so just say it's over
+			task_status = task['status']
+			yield "event: task\ndata: " + json.dumps({'action': 'task', 'status': task_status}) + "\n\n"
+
+		deadline = time.time() + app.config['TASK_EVENT_STREAM_MAX_DURATION']
+		while task_status in (None,) + TASK_PENDING_STATUSES and time.time() < deadline:
+			message = pubsub.get_message(timeout=15)
+
+			if message is None:
+				# Keep the connection open, and check the task hasn't ended
+				# without telling us (e.g. neocortex was killed)
+				yield ": keepalive\n\n"
+
+				g.db.commit()
+				task = task_get(task['id'])
+				if not task_is_pending(task):
+					yield "event: task\ndata: " + json.dumps({'action': 'task', 'status': task['status']}) + "\n\n"
+					break
+
+			else:
+				record = json.loads(message['data'])
+				if record['seq'] <= last_event_id:
+					continue
+
+				last_event_id = record['seq']
+				yield _task_event_message(record['seq'], message['data'])
+
+				if record['action'] == 'task':
+					task_status = record['status']
+
+	finally:
+		pubsub.close()
+
+################################################################################
+
 def log(source, name, desc, username=None, related_id=None, success=True):
 	"""
 	Record a message in the 'events' table, i.e. generate a log record
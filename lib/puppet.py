@@ -1,9 +1,13 @@
+import datetime
+import json
+
 import MySQLdb as mysql
 import pypuppetdb
 import yaml
 from flask import g, session, url_for
 
-import cortex.lib.systems
+import cortex.corpus.puppet_enc_cache
+import cortex.corpus.puppetdb_connector
 from cortex import app
 
 ################################################################################
@@ -61,23 +65,89 @@ def get_puppetdb_environments(db=None, whitelist=None):
 
 ################################################################################
 
-def generate_node_config(certname):
-	"""Generates a YAML document describing the configuration of a particular
-	node given as 'certname'."""
+def invalidate_node_config(certname=None):
+	"""Invalidates the cached ENC document of the node given as 'certname',
+	or of every node (and the default classes) if no certname is given.
+	This must be called after committing any change to the data that the
+	ENC documents are generated from."""
 
-	# Get a cursor to the database
-	curd = g.db.cursor(mysql.cursors.DictCursor)
+	try:
+		cortex.corpus.puppet_enc_cache.invalidate(g.redis, None if certname is None else [certname])
+	except Exception as ex:
+		app.logger.error('Failed to invalidate Puppet ENC cache: %s' %(ex))
 
-	# Get the Puppet node from the database
-	curd.execute("SELECT `id`, `classes`, `variables`, `env`, `include_default` FROM `puppet_nodes` WHERE `certname` = %s", (certname,))
-	node = curd.fetchone()
+################################################################################
 
-	# If we don't find the node, return nothing
-	if node is None:
+def get_changed_node_configs(since):
+	"""Returns the set of certnames whose ENC documents may have changed
+	since the given time (as a UNIX timestamp), or None if every document
+	may have changed or we can't tell."""
+
+	try:
+		cortex.corpus.puppet_enc_cache.prune_changes(g.redis, app.config['PUPPET_ENC_CHANGES_RETENTION'])
+		return cortex.corpus.puppet_enc_cache.changed_since(g.redis, since)
+	except Exception as ex:
+		app.logger.warning('Failed to read changed Puppet ENC documents from cache: %s' %(ex))
 		return None
 
-	# Get the system
-	system = cortex.lib.systems.get_system_by_id(node['id'])
+################################################################################
+
+def generate_node_configs(certnames=None):
+	"""Generates the ENC documents of every node, or only those named in
+	certnames (skipping any which don't exist), yielding a tuple of the
+	certname and the YAML document for each node. If a node's document
+	can't be generated, the error is logged and it is yielded as None."""
+
+	curd = g.db.cursor(mysql.cursors.DictCursor)
+	if certnames is None:
+		curd.execute(ENC_NODE_QUERY + " ORDER BY `puppet_nodes`.`certname`")
+	elif certnames:
+		certnames = list(certnames)
+		curd.execute(ENC_NODE_QUERY + " WHERE `puppet_nodes`.`certname` IN (" + ", ".join(["%s"] * len(certnames)) + ") ORDER BY `puppet_nodes`.`certname`", certnames)
+	else:
+		return
+
+	default_classes = None
+	for node in curd.fetchall():
+		# Use the cached document, if there is one. The node was read before
+		# we checked its version, so we don't cache what we generate here.
+		node_yaml = None
+		try:
+			node_yaml = cortex.corpus.puppet_enc_cache.get_node(g.redis, node['certname'])[1]
+		except Exception as ex:
+			app.logger.warning('Failed to read Puppet ENC cache for node ' + str(node['certname']) + ': %s' %(ex))
+
+		if node_yaml is None:
+			try:
+				if default_classes is None:
+					default_classes = get_default_classes(curd)
+				node_yaml = _build_node_config(node, default_classes)
+			except Exception as ex:
+				app.logger.error('Failed to generate Puppet ENC for node ' + str(node['certname']) + ': %s' %(ex))
+
+		yield (node['certname'], node_yaml)
+
+################################################################################
+
+# The details of a Puppet node and its system that its ENC document is
+# generated from
+ENC_NODE_QUERY = "SELECT `puppet_nodes`.`id` AS `id`, `puppet_nodes`.`certname` AS `certname`, `puppet_nodes`.`classes` AS `classes`, `puppet_nodes`.`variables` AS `variables`, `puppet_nodes`.`env` AS `env`, `puppet_nodes`.`include_default` AS `include_default`, `systems_info_view`.`id` AS `system_id`, `systems_info_view`.`cmdb_id` AS `cmdb_id`, `systems_info_view`.`cmdb_environment` AS `cmdb_environment`, `systems_info_view`.`cmdb_description` AS `cmdb_description` FROM `puppet_nodes` LEFT JOIN `systems_info_view` ON `systems_info_view`.`id` = `puppet_nodes`.`id`"
+
+def get_default_classes(curd=None):
+	"""Gets the parsed Puppet default classes, which are kept in the
+	puppet.enc.default setting as YAML."""
+
+	# Use the copy in the cache, if there is one
+	version = None
+	try:
+		version, cached = cortex.corpus.puppet_enc_cache.get_default_classes(g.redis)
+		if cached is not None:
+			return json.loads(cached)
+	except Exception as ex:
+		app.logger.warning('Failed to read Puppet default classes from cache: %s' %(ex))
+
+	if curd is None:
+		curd = g.db.cursor(mysql.cursors.DictCursor)
 
 	# Get the Puppet default classes
 	curd.execute("SELECT `value` FROM `kv_settings` WHERE `key` = 'puppet.enc.default'")
@@ -94,6 +164,73 @@ def generate_node_config(certname):
 	else:
 		default_classes = {}
 
+	if version is not None:
+		try:
+			cortex.corpus.puppet_enc_cache.set_default_classes(g.redis, version, json.dumps(default_classes), app.config['PUPPET_ENC_CACHE_EXPIRE'])
+		except Exception as ex:
+			app.logger.warning('Failed to cache Puppet default classes: %s' %(ex))
+
+	return default_classes
+
+################################################################################
+
+def generate_node_config(certname):
+	"""Generates a YAML document describing the configuration of a particular
+	node given as 'certname'. Documents are cached in Redis until they are
+	invalidated by invalidate_node_config, or PUPPET_ENC_CACHE_EXPIRE seconds
+	have passed."""
+
+	# Use the cached document, if there is one
+	version = None
+	try:
+		version, node_yaml = cortex.corpus.puppet_enc_cache.get_node(g.redis, certname)
+		if node_yaml is not None:
+			return node_yaml
+	except Exception as ex:
+		app.logger.warning('Failed to read Puppet ENC cache for node ' + str(certname) + ': %s' %(ex))
+
+	node_yaml = _generate_node_config(certname)
+
+	# Cache the document, marked with the version of its inputs from before
+	# we generated it, so if they are changed while we were generating it
+	# this document won't be used
+	if node_yaml is not None and version is not None:
+		try:
+			cortex.corpus.puppet_enc_cache.set_node(g.redis, certname, version, node_yaml, app.config['PUPPET_ENC_CACHE_EXPIRE'])
+		except Exception as ex:
+			app.logger.warning('Failed to cache Puppet ENC for node ' + str(certname) + ': %s' %(ex))
+
+	return node_yaml
+
+################################################################################
+
+def _generate_node_config(certname):
+	"""Generates the YAML document describing the configuration of a
+	particular node given as 'certname' from the database."""
+
+	# Get a cursor to the database
+	curd = g.db.cursor(mysql.cursors.DictCursor)
+
+	# Get the Puppet node and its system from the database
+	curd.execute(ENC_NODE_QUERY + " WHERE `puppet_nodes`.`certname` = %s", (certname,))
+	node = curd.fetchone()
+
+	# If we don't find the node, return nothing
+	if node is None:
+		return None
+
+	return _build_node_config(node, get_default_classes(curd))
+
+################################################################################
+
+def _build_node_config(node, default_classes):
+	"""Builds the YAML document describing the configuration of a Puppet
+	node from its row of ENC_NODE_QUERY and the Puppet default classes."""
+
+	certname = node['certname']
+	if node['system_id'] is None:
+		raise ValueError('Puppet node ' + str(certname) + ' is not linked to a system')
+
 	# Start building response
 	response = {'environment': node['env']}
 
@@ -130,20 +267,20 @@ def generate_node_config(certname):
 		response['parameters'] = {}
 
 	# Add in (and indeed potentially overwrite) some auto-generated variables
-	if 'cmdb_id' not in system or system['cmdb_id'] is None or len(system['cmdb_id'].strip()) == 0:
+	if node['cmdb_id'] is None or len(node['cmdb_id'].strip()) == 0:
 		# Not linked to a ServiceNow entry, put in some defaults
-		response['parameters']['uos_motd_sn_environment'] = 'ERROR: Not linked to ServiceNow. Visit: ' + url_for('system_edit', _external=True, system_id=system['id'])
-		response['parameters']['uos_motd_sn_description'] = 'ERROR: Not linked to ServiceNow. Visit: ' + url_for('system_edit', _external=True, system_id=system['id'])
+		response['parameters']['uos_motd_sn_environment'] = 'ERROR: Not linked to ServiceNow. Visit: ' + url_for('system_edit', _external=True, system_id=node['system_id'])
+		response['parameters']['uos_motd_sn_description'] = 'ERROR: Not linked to ServiceNow. Visit: ' + url_for('system_edit', _external=True, system_id=node['system_id'])
 		# The 'uos_environment' will default to Unknown
 		response['parameters']['uos_environment'] = 'Unknown'
 	else:
-		response['parameters']['uos_motd_sn_environment'] = system['cmdb_environment']
-		if system['cmdb_description'] is None or len(system['cmdb_description'].strip()) == 0:
-			response['parameters']['uos_motd_sn_description'] = 'ERROR: Description not set in ServiceNow. Visit: ' + (app.config['CMDB_URL_FORMAT'] % system['cmdb_id'])
+		response['parameters']['uos_motd_sn_environment'] = node['cmdb_environment']
+		if node['cmdb_description'] is None or len(node['cmdb_description'].strip()) == 0:
+			response['parameters']['uos_motd_sn_description'] = 'ERROR: Description not set in ServiceNow. Visit: ' + (app.config['CMDB_URL_FORMAT'] % node['cmdb_id'])
 		else:
-			response['parameters']['uos_motd_sn_description'] = system['cmdb_description']
+			response['parameters']['uos_motd_sn_description'] = node['cmdb_description']
 		# The 'uos_environment' will become 'cmdb_environment'
-		response['parameters']['uos_environment'] = system['cmdb_environment']
+		response['parameters']['uos_environment'] = node['cmdb_environment']
 
 	return yaml.safe_dump(response, sort_keys=True)
 
@@ -169,44 +306,85 @@ def puppetdb_query(endpoint, db=None, **kwargs):
 
 ################################################################################
 
-def puppetdb_get_node_statuses(db=None):
-	"""Gets the statuses of all the nodes"""
+def puppetdb_get_node_snapshot(db=None, node_names=None):
+	"""Gets the latest report status and environment of every node, or just
+	of the nodes named in node_names, as a dictionary keyed by certname. These
+	come from the snapshot kept in Redis by the _cache_puppetdb task if there
+	is one, or from PuppetDB if not."""
+
+	if node_names is not None:
+		node_names = list(node_names)
+		if not node_names:
+			return {}
+
+	try:
+		if g.redis.exists('puppetdb/nodes/updated'):
+			if node_names is None:
+				nodes = g.redis.hgetall('puppetdb/nodes')
+			else:
+				nodes = dict(zip(node_names, g.redis.hmget('puppetdb/nodes', node_names)))
+			return {certname: json.loads(node) for certname, node in nodes.items() if node is not None}
+	except Exception as ex:
+		app.logger.warning('Failed to read PuppetDB node snapshot from Redis: %s' %(ex))
+
+	# Query PuppetDB for the node statuses, asking only for the nodes we want
+	query = ["extract", cortex.corpus.puppetdb_connector.NODE_FIELDS]
+	if node_names is not None:
+		query.append(["in", "certname", ["array", node_names]])
+	node_statuses = cortex.lib.puppet.puppetdb_query('nodes', db=db, query=json.dumps(query))
+	return {node["certname"]: node for node in node_statuses}
+
+################################################################################
 
-	if db is None:
-		db = puppetdb_connect()
+def puppetdb_get_node_statuses(db=None, node_names=None):
+	"""Gets the statuses of all the nodes, or just of the nodes named in
+	node_names"""
 
-	# Query PuppetDB to get all node statuses
-	node_statuses = cortex.lib.puppet.puppetdb_query('nodes', query='["extract", ["certname", "latest_report_status", "latest_report_noop", "latest_report_hash"]]')
-	return {node["certname"]: node for node in node_statuses}
+	return puppetdb_get_node_snapshot(db, node_names)
 
 ################################################################################
 
-def puppetdb_get_node_status(node_name, db=None):
-	"""Gets the latest status of a a given node, where node_name is the Puppet certificate name"""
+def puppetdb_node_status(node, unreported=2):
+	"""Works out the status of a node from its latest report in the same
+	way as pypuppetdb does, where node is a dictionary of the fields in
+	cortex.corpus.puppetdb_connector.NODE_FIELDS. Nodes which haven't reported in the last
+	unreported hours are 'unreported', and nodes whose latest report was a
+	noop run with changes pending are 'noop'."""
 
-	if db is None:
-		db = puppetdb_connect()
+	if node.get('report_timestamp') is None:
+		return 'unreported'
 
-	# Get information about all the nodes, including their status
-	nodes = db.nodes(with_status=True)
+	# PuppetDB timestamps are in UTC, e.g. 2020-01-01T12:00:00.000Z
+	try:
+		report_timestamp = datetime.datetime.strptime(node['report_timestamp'][:19], '%Y-%m-%dT%H:%M:%S')
+	except ValueError:
+		return 'unreported'
+	if report_timestamp < datetime.datetime.utcnow() - datetime.timedelta(hours=unreported):
+		return 'unreported'
 
-	# Iterate over nodes, looking for a specific node
-	for node in nodes:
-		if node.name == node_name:
-			return node.status
+	if node.get('latest_report_noop') and node.get('latest_report_noop_pending'):
+		return 'noop'
 
-	return None
+	return node.get('latest_report_status')
+
+################################################################################
+
+def puppetdb_get_node_status(node_name, db=None):
+	"""Gets the latest status of a a given node, where node_name is the Puppet certificate name"""
+
+	node = puppetdb_get_node_snapshot(db, [node_name]).get(node_name)
+	if node is None:
+		return None
+
+	return puppetdb_node_status(node)
 
 ################################################################################
 
 def puppetdb_get_node_stats_totals(db=None):
 	"""Calculate statistics on node statuses by talking to PuppetDB"""
 
-	if db is None:
-		db = puppetdb_connect()
-
-	# Query PuppetDB to get all node statuses
-	node_statuses = cortex.lib.puppet.puppetdb_query('nodes', query='["extract", ["certname", "latest_report_status", "latest_report_noop", "latest_report_hash"]]')
+	# Get all node statuses
+	node_statuses = puppetdb_get_node_snapshot(db).values()
 
 	# Initialise stats
 	stats = {
@@ -244,9 +422,6 @@ def puppetdb_get_node_stats(db=None, environments=None):
 
 	stats_template = {"count": 0, "unchanged": 0, "changed": 0, "noop": 0, "failed": 0, "unreported": 0, "unknown": 0}
 
-	if db is None:
-		db = puppetdb_connect()
-
 	stats = {}
 
 	# If a list of environment names were given, initialise them
@@ -254,8 +429,8 @@ def puppetdb_get_node_stats(db=None, environments=None):
 		for env in environments:
 			stats[env] = stats_template.copy()
 
-	# Query PuppetDB to get all node statuses
-	node_statuses = cortex.lib.puppet.puppetdb_query('nodes', query='["extract", ["certname", "report_environment", "latest_report_status", "latest_report_noop", "latest_report_hash"]]')
+	# Get all node statuses
+	node_statuses = puppetdb_get_node_snapshot(db).values()
 
 	# Iterate over nodes, counting per-environment statistics
 	for node in node_statuses:
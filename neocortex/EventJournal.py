@@ -0,0 +1,91 @@
+
+import time
+
+
+class EventJournal:
+	"""Buffers the event rows written by a task and writes them to the `events`
+	table in batches rather than committing every change individually. The
+	buffer is written, in order, once it holds flush_size changes or is older
+	than flush_interval seconds, whenever a new in-progress event is started
+	(so that it gets an ID to be updated by), when the task ends and before
+	the task waits for anything slow (see Corpus.before_wait). The age of
+	the buffer is only checked when something is written to it."""
+
+	INSERT_SQL = "INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+
+	def __init__(self, db, flush_size=50, flush_interval=5):
+		"""Initialises the EventJournal object"""
+
+		self.db = db
+		self.curd = db.cursor()
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+
+		## An ordered list of ('insert', row) and ('update', event_id, fields)
+		self.pending = []
+		self.last_flush = time.time()
+
+	def insert(self, row):
+		"""Queues a finished event to be inserted. The row is a tuple of source,
+		related_id, name, username, desc, status, start and end."""
+
+		self.pending.append(('insert', row))
+		self._flush_if_due()
+
+	def open(self, row):
+		"""Writes a new in-progress event, along with anything already buffered,
+		and returns the ID of the new event"""
+
+		self.flush(commit=False)
+		self.curd.execute(self.INSERT_SQL, row)
+		event_id = self.curd.lastrowid
+		self.db.commit()
+
+		return event_id
+
+	def update(self, event_id, **fields):
+		"""Queues changes to the columns of an event which has been opened"""
+
+		## Merge consecutive changes to the same event in to one UPDATE
+		if self.pending and self.pending[-1][0] == 'update' and self.pending[-1][1] == event_id:
+			self.pending[-1][2].update(fields)
+		else:
+			self.pending.append(('update', event_id, fields))
+
+		self._flush_if_due()
+
+	def _flush_if_due(self):
+		if len(self.pending) >= self.flush_size or time.time() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self, commit=True):
+		"""Writes all the buffered changes to the database in the order they
+		were made, grouping runs of inserts into multi-row INSERTs. If a
+		statement fails, the changes written before it are left in the open
+		transaction (which is shared with the task, so isn't rolled back
+		here) and dropped from the buffer, and the rest are kept so they can
+		be written again later without writing any change twice."""
+
+		index = 0
+		try:
+			while index < len(self.pending):
+				if self.pending[index][0] == 'insert':
+					end = index
+					while end < len(self.pending) and self.pending[end][0] == 'insert':
+						end += 1
+
+					## MySQLdb turns this in to a single multi-row INSERT
+					self.curd.executemany(self.INSERT_SQL, [change[1] for change in self.pending[index:end]])
+					index = end
+				else:
+					event_id, fields = self.pending[index][1:]
+					columns = sorted(fields.keys())
+					self.curd.execute("UPDATE `events` SET " + ", ".join("`" + column + "` = %s" for column in columns) + " WHERE `id` = %s", [fields[column] for column in columns] + [event_id])
+					index += 1
+		finally:
+			## Forget whatever has been written
+			self.pending = self.pending[index:]
+
+		if commit:
+			self.db.commit()
+		self.last_flush = time.time()
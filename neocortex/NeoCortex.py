@@ -7,24 +7,30 @@ import multiprocessing
 import os
 import signal
 import sys
+import time
 import grp
 import pwd
-from multiprocessing import Process
 
 import MySQLdb as mysql
 import Pyro4
+import serpent
 from setproctitle import setproctitle
 
 # bin/neocortex modifies sys.path so these are importable.
 # pylint: disable=import-error,no-name-in-module
 from corpus import Corpus
 from neocortex.TaskHelper import TaskHelper
+from neocortex.TaskRegistry import TaskRegistry
 # pylint: enable=import-error,no-name-in-module
 
 CONFIG_BASE_DIR = '/data/cortex'
 Pyro4.config.SERVERTYPE = "multiplex"
 Pyro4.config.SOCK_REUSE = True
 
+## Workers are always forked from this (already warm) process so that they
+## inherit the task modules and libraries it has loaded
+Process = multiprocessing.get_context('fork').Process
+
 # pylint: disable=no-self-use
 class NeoCortex:
 
@@ -32,6 +38,8 @@ class NeoCortex:
 	db = None
 	pyro = None
 	logger = None
+	registry = None
+	last_dispatch = 0
 
 	## PRIVATE METHODS #########################################################
 
@@ -50,6 +58,10 @@ class NeoCortex:
 		self._load_neocortex_config(CONFIG_BASE_DIR)
 		self._drop_privs()
 
+		## Load the task modules and heavy dependencies once, up front
+		self.registry = TaskRegistry(self.config)
+		self.registry.preload()
+
 		## Store the copy of the pyro daemon object
 		self.pyro = pyro
 
@@ -60,6 +72,9 @@ class NeoCortex:
 		## preload a connection to mysql
 		self._get_db()
 
+		## Pick up anything left on the task queue when neocortex last stopped
+		self._recover_tasks()
+
 	def _signal_handler_term(self, _signum, _frame):
 		self._signal_handler('SIGTERM')
 
@@ -166,16 +181,193 @@ class NeoCortex:
 		else:
 			os.setuid(pwd.getpwnam(self.config['NEOCORTEX_SET_UID']).pw_uid)
 
-	def _record_task(self, module_name, username, description=None):
+	def _record_task(self, task_type, task_name, task_file, username, options, description=None):
+		"""Records a new task and places it on the task queue in a single
+		transaction, returning the ID of the task"""
+
+		## Store the options in the same way Pyro sent them to us, so tasks get
+		## exactly what they were given (e.g. sets and tuples) as they used to
+		try:
+			options_data = serpent.dumps(options).decode('utf-8')
+		except Exception as ex:
+			raise ValueError("The task options could not be serialised: " + str(ex))
+
+		curd = self._get_cursor()
+		curd.execute("INSERT INTO `tasks` (`module`, `username`, `start`, `status`, `description`) VALUES (%s, %s, NOW(), %s, %s)", (task_name, username, TaskHelper.STATUS_QUEUED, description))
+		task_id = curd.lastrowid
+		curd.execute("INSERT INTO `task_queue` (`task_id`, `type`, `name`, `file`, `options`, `priority`, `interactive`, `retryable`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", (task_id, task_type, task_name, task_file, options_data, self._task_priority(task_type, task_name, username), username != 'scheduler', task_name in self.config.get('NEOCORTEX_RETRYABLE_TASKS', [])))
+		self.db.commit()
+		return task_id
+
+	def _task_priority(self, task_type, task_name, username):
+		"""Returns the queue priority of a task. Workflows come first, then
+		internal tasks started by users and finally the scheduled jobs, unless
+		NEOCORTEX_TASK_PRIORITIES says otherwise."""
+
+		priorities = self.config.get('NEOCORTEX_TASK_PRIORITIES', {})
+		if task_name in priorities:
+			return priorities[task_name]
+		elif task_type == 'workflow':
+			return 20
+		elif username != 'scheduler':
+			return 10
+		else:
+			return 0
+
+	def _queue_task(self, task_type, task_name, task_file, username, options, description=None):
+		"""Records a task as queued and then starts it straight away if there
+		is a free worker for it"""
+
+		task_id = self._record_task(task_type, task_name, task_file, username, options, description)
+		self.logger.info("queued task %s/%s with task id %s", task_type, task_name, task_id)
+
+		self._dispatch()
+
+		return task_id
+
+	def _recover_tasks(self):
+		"""Called at startup. Anything holding a lease on the queue belonged
+		to the previous neocortex process, so reclaim it now rather than
+		waiting for the lease to run out. Tasks which never left the queue are
+		simply dispatched as normal."""
+
+		curd = self._get_cursor()
+		curd.execute("SELECT `task_queue`.*, `tasks`.`status` FROM `task_queue` JOIN `tasks` ON `task_queue`.`task_id` = `tasks`.`id` WHERE `task_queue`.`lease_expires` IS NOT NULL")
+		for queued_task in curd.fetchall():
+			self._reclaim_task(queued_task, 'neocortex restarted whilst the task was running')
+
+	def _reclaim_expired_leases(self, running_ids):
+		"""Reclaims tasks whose worker has stopped renewing its lease, i.e. the
+		worker has died without finishing the task"""
+
+		curd = self._get_cursor()
+		curd.execute("SELECT `task_queue`.*, `tasks`.`status` FROM `task_queue` JOIN `tasks` ON `task_queue`.`task_id` = `tasks`.`id` WHERE `task_queue`.`lease_expires` < NOW()")
+		for queued_task in curd.fetchall():
+			## A late heartbeat from a worker we can see is still alive is not
+			## a reason to start the task again
+			if queued_task['task_id'] not in running_ids:
+				self._reclaim_task(queued_task, 'the worker running the task stopped responding')
+
+	def _reclaim_task(self, queued_task, reason):
+		"""Puts a task whose worker was lost back on the queue if it is safe to
+		run again and has attempts left, otherwise marks it as failed"""
+
+		curd = self._get_cursor()
+
+		## Close off any events the lost worker left in progress
+		curd.execute("UPDATE `events` SET `status` = %s, `end` = NOW() WHERE `source` = %s AND `related_id` = %s AND `status` = %s", (TaskHelper.STATUS_FAILED, 'neocortex.task', queued_task['task_id'], TaskHelper.STATUS_PROGRESS))
+
+		if queued_task['status'] not in (TaskHelper.STATUS_PROGRESS, TaskHelper.STATUS_QUEUED):
+			## The task has already been ended (e.g. by expire_old_tasks)
+			curd.execute("DELETE FROM `task_queue` WHERE `task_id` = %s", (queued_task['task_id'],))
+		elif queued_task['retryable'] and queued_task['attempts'] < self.config.get('NEOCORTEX_TASK_MAX_ATTEMPTS', 3):
+			curd.execute("INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())", ('neocortex.task', queued_task['task_id'], queued_task['name'] + '.neocortex.requeue', 'neocortex', 'The task was queued to run again because ' + reason, TaskHelper.STATUS_WARNED))
+			curd.execute("UPDATE `task_queue` SET `lease_expires` = NULL WHERE `task_id` = %s", (queued_task['task_id'],))
+			curd.execute("UPDATE `tasks` SET `status` = %s WHERE `id` = %s", (TaskHelper.STATUS_QUEUED, queued_task['task_id']))
+			self.logger.warning("requeued task id %s because %s", queued_task['task_id'], reason)
+		else:
+			curd.execute("INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())", ('neocortex.task', queued_task['task_id'], queued_task['name'] + '.neocortex.lost', 'neocortex', 'The task failed because ' + reason, TaskHelper.STATUS_FAILED))
+			curd.execute("DELETE FROM `task_queue` WHERE `task_id` = %s", (queued_task['task_id'],))
+			curd.execute("UPDATE `tasks` SET `status` = %s, `end` = NOW() WHERE `id` = %s", (TaskHelper.STATUS_FAILED, queued_task['task_id']))
+			self.logger.warning("failed task id %s because %s", queued_task['task_id'], reason)
+
+		self.db.commit()
+
+	def _dispatch(self):
+		"""Starts queued tasks, highest priority first, while there are free
+		workers. Scheduled jobs may not use the last few workers, which are
+		kept for interactive tasks, and tasks whose workflow is already running
+		as many times as NEOCORTEX_WORKFLOW_CONCURRENCY allows are skipped over
+		and left on the queue."""
+
+		self.last_dispatch = time.monotonic()
+
+		## This also reaps any finished tasks
+		active_processes = multiprocessing.active_children()
+
+		running = {}
+		running_ids = []
+		for proc in active_processes:
+			proc_data = json.loads(proc.name)
+			running[proc_data['name']] = running.get(proc_data['name'], 0) + 1
+			running_ids.append(proc_data['id'])
+
+		self._reclaim_expired_leases(running_ids)
+
+		free_workers = self.config.get('NEOCORTEX_MAX_WORKERS', 16) - len(active_processes)
+		free_scheduled_workers = free_workers - self.config.get('NEOCORTEX_RESERVED_INTERACTIVE_WORKERS', 4)
+		concurrency = self.config.get('NEOCORTEX_WORKFLOW_CONCURRENCY', {})
+
+		if free_workers <= 0:
+			return
+
 		curd = self._get_cursor()
-		curd.execute("INSERT INTO `tasks` (`module`, `username`, `start`, `description`) VALUES (%s, %s, NOW(), %s)", (module_name, username, description))
+		curd.execute("SELECT `task_queue`.*, `tasks`.`username` FROM `task_queue` JOIN `tasks` ON `task_queue`.`task_id` = `tasks`.`id` WHERE `task_queue`.`lease_expires` IS NULL ORDER BY `task_queue`.`priority` DESC, `task_queue`.`task_id`")
+		for queued_task in curd.fetchall():
+			if free_workers <= 0:
+				break
+
+			if not queued_task['interactive'] and free_scheduled_workers <= 0:
+				continue
+
+			if queued_task['name'] in concurrency and running.get(queued_task['name'], 0) >= concurrency[queued_task['name']]:
+				continue
+
+			if self._start_task(queued_task):
+				running[queued_task['name']] = running.get(queued_task['name'], 0) + 1
+				free_workers -= 1
+				free_scheduled_workers -= 1
+
+	def _load_options(self, options_data):
+		"""Loads the options of a queued task, as stored by _record_task"""
+
+		try:
+			return serpent.loads(options_data)
+		except Exception:
+			## Tasks queued before the options were stored with serpent
+			return json.loads(options_data)
+
+	def _start_task(self, queued_task):
+		"""Takes a lease on a queued task and forks a worker process to run
+		it. Returns True if the task was started."""
+
+		curd = self._get_cursor()
+
+		try:
+			task_module = self.registry.load(queued_task['name'], queued_task['file'])
+		except Exception as ex:
+			self.logger.error("failed to load task: %s: %s", queued_task['file'], ex)
+			curd.execute("INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())", ('neocortex.task', queued_task['task_id'], queued_task['name'] + '.neocortex.load', 'neocortex', 'The task failed because it could not be loaded: ' + str(ex), TaskHelper.STATUS_FAILED))
+			curd.execute("DELETE FROM `task_queue` WHERE `task_id` = %s", (queued_task['task_id'],))
+			curd.execute("UPDATE `tasks` SET `status` = %s, `end` = NOW() WHERE `id` = %s", (TaskHelper.STATUS_FAILED, queued_task['task_id']))
+			self.db.commit()
+			return False
+
+		curd.execute("UPDATE `task_queue` SET `lease_expires` = DATE_ADD(NOW(), INTERVAL %s SECOND), `attempts` = `attempts` + 1 WHERE `task_id` = %s", (self.config.get('NEOCORTEX_TASK_LEASE', 120), queued_task['task_id']))
+		curd.execute("UPDATE `tasks` SET `status` = %s, `start` = NOW() WHERE `id` = %s", (TaskHelper.STATUS_PROGRESS, queued_task['task_id']))
 		self.db.commit()
-		return curd.lastrowid
+
+		task_helper = TaskHelper(self.config, queued_task['name'], queued_task['task_id'], queued_task['username'], retryable=bool(queued_task['retryable']))
+		task = Process(target=task_helper.run, args=(task_module, self._load_options(queued_task['options'])), name=json.dumps({'id': queued_task['task_id'], 'name': queued_task['name'], 'type': queued_task['type']}))
+		task.start()
+
+		self.logger.info("started task %s/%s with task id %s and worker pid %s", queued_task['type'], queued_task['name'], queued_task['task_id'], task.pid)
+
+		return True
 
 	## This is called on each pyro loop timeout/run to make sure defunct processes
-	## (finished tasks waiting for us to reap them) are reaped
+	## (finished tasks waiting for us to reap them) are reaped, and to start any
+	## queued tasks which now have a free worker. As it runs on every RPC call
+	## it does this at most every NEOCORTEX_DISPATCH_INTERVAL seconds.
 	def _onloop(self):
-		multiprocessing.active_children()
+		if time.monotonic() - self.last_dispatch < self.config.get('NEOCORTEX_DISPATCH_INTERVAL', 1):
+			return True
+
+		try:
+			self._dispatch()
+		except Exception as ex:
+			self.logger.error("failed to dispatch queued tasks: %s", ex)
+
 		return True
 
 	## RPC METHODS #############################################################
@@ -205,30 +397,22 @@ class NeoCortex:
 
 		task_file = os.path.join(fqp, "task.py")
 		try:
-			task_module = imp.load_source(workflow_name, task_file)
+			self.registry.load(workflow_name, task_file)
 		except Exception as ex:
 			raise ImportError("Could not load workflow from file " + task_file + ": " + str(ex))
 
-		task_id = self._record_task(workflow_name, username, description)
-		task_helper = TaskHelper(self.config, workflow_name, task_id, username)
-		task = Process(target=task_helper.run, args=(task_module, options), name=json.dumps({'id': task_id, 'name': workflow_name, 'type': 'workflow'}))
-		task.start()
-
-		self.logger.info("started task workflow/%s with task id %s and worker pid %s", workflow_name, task_id, task.pid)
-
-		return task_id
+		return self._queue_task('workflow', workflow_name, task_file, username, options, description)
 
 	## This function allows arbitrary taks to be called
 	@Pyro4.expose
 	def start_internal_task(self, username, task_file, task_name, options=None, description=None):
 
-		## Ensure that task_name is not already running
-		active_processes = multiprocessing.active_children()
-		for proc in active_processes:
-			proc_data = json.loads(proc.name)
-			if proc_data['name'] == task_name:
-				self.logger.error("refusing to start a second instance of task: %s", task_name)
-				raise Exception("That task is already running, refusing to start another instance")
+		## Ensure that task_name is not already running or waiting to run
+		curd = self._get_cursor()
+		curd.execute("SELECT `task_id` FROM `task_queue` WHERE `name` = %s", (task_name,))
+		if curd.fetchone() is not None:
+			self.logger.error("refusing to start a second instance of task: %s", task_name)
+			raise Exception("That task is already running, refusing to start another instance")
 
 		if not os.path.isdir(self.config['NEOCORTEX_TASKS_DIR']):
 			raise IOError("The config option NEOCORTEX_TASKS_DIR is not a directory")
@@ -240,19 +424,12 @@ class NeoCortex:
 			raise IOError("The neocortex task file specified was not found")
 
 		try:
-			task_module = imp.load_source(task_name, task_file)
+			self.registry.load(task_name, task_file)
 		except Exception as ex:
 			self.logger.error("failed to load task: %s: %s", task_file, ex)
 			raise ImportError("Could not load internal task from file " + task_file + ": " + str(ex))
 
-		task_id = self._record_task(task_name, username, description)
-		task_helper = TaskHelper(self.config, task_name, task_id, username)
-		task = Process(target=task_helper.run, args=(task_module, options), name=json.dumps({'id': task_id, 'name': task_name, 'type': 'internal'}))
-		task.start()
-
-		self.logger.info("started task internal/%s with task id %s and worker pid %s", task_name, task_id, task.pid)
-
-		return task_id
+		return self._queue_task('internal', task_name, task_file, username, options, description)
 
 	## This function allows the Flask web app to allocate names (as well as tasks)
 	@Pyro4.expose
@@ -260,7 +437,8 @@ class NeoCortex:
 		lib = Corpus(self._get_db(), self.config)
 		return lib.allocate_name(class_name, system_comment, username)
 
-	## List active tasks - returns a list of task ids
+	## List active tasks, including those queued waiting for a worker - returns
+	## a list of dictionaries containing the task id, name and type
 	@Pyro4.expose
 	def active_tasks(self):
 		active_processes = multiprocessing.active_children()
@@ -269,4 +447,9 @@ class NeoCortex:
 			proc_data = json.loads(proc.name)
 			active_tasks.append(proc_data)
 
+		curd = self._get_cursor()
+		curd.execute("SELECT `task_id`, `name`, `type` FROM `task_queue` WHERE `lease_expires` IS NULL ORDER BY `priority` DESC, `task_id`")
+		for queued_task in curd.fetchall():
+			active_tasks.append({'id': queued_task['task_id'], 'name': queued_task['name'], 'type': queued_task['type']})
+
 		return active_tasks
@@ -1,7 +1,10 @@
 
+import datetime
+import json
 import logging
 import signal
 import sys
+import threading
 import traceback
 
 import MySQLdb as mysql
@@ -10,6 +13,7 @@ from setproctitle import setproctitle  # pip install setproctitle
 # bin/neocortex modifies sys.path so these are importable.
 # pylint: disable=import-error
 from corpus import Corpus
+from neocortex.EventJournal import EventJournal
 # pylint: enable=import-error
 
 
@@ -22,6 +26,7 @@ class TaskHelper:
 	STATUS_FAILED = 2
 	STATUS_WARNED = 3
 	STATUS_CHANGED = 4
+	STATUS_QUEUED = 5
 
 	# Flash Message Category Map
 	CATEGORY_MAP = {
@@ -32,32 +37,74 @@ class TaskHelper:
 		'fatal'  : {'success': False, 'warning': False},
 	}
 
-	def __init__(self, config, workflow_name, task_id, username):
+	def __init__(self, config, workflow_name, task_id, username, retryable=False):
 		"""Initialises the TaskHelper object"""
 
 		self.config = config
 		self.workflow_name = workflow_name
 		self.task_id = task_id
 		self.username = username
+		self.retryable = retryable
 		self.event_id = -1
+		self.event_seq = None
 		self.event_problems = 0
 		self.logger = logging.getLogger('neocortex')
 		self.db = None
 		self.curd = None
 		self.lib = None
+		self.journal = None
+		self.heartbeat_stop = threading.Event()
 
 	def _signal_handler(self, _signum, _frame):
-		"""Marks task and event as failed when interrupted by a signal, and then exits"""
+		"""Marks task and event as failed when interrupted by a signal, and then exits.
+		Tasks which are safe to run again are put back on the queue instead."""
 
 		self.logger.info("task id %s caught exit signal", self.task_id)
 
 		self.end_event(success=False)
-		self.event('neocortex.shutdown', 'The task was terminated because neocortex was asked to shutdown')
-		self._end_task(success=False)
+		if self.retryable:
+			self.event('neocortex.shutdown', 'The task was interrupted because neocortex was asked to shutdown, and will be run again', oneshot=True, warning=True)
+			self._requeue_task()
+			self._publish({'action': 'task', 'status': self.STATUS_QUEUED})
+			self.logger.warning("task id %s returned to the queue", self.task_id)
+		else:
+			self.event('neocortex.shutdown', 'The task was terminated because neocortex was asked to shutdown')
+			self._end_task(success=False)
+			self.logger.warning("task id %s marked as finished", self.task_id)
 
-		self.logger.warning("task id %s marked as finished", self.task_id)
 		sys.exit(0)
 
+	def _heartbeat(self):
+		"""Renews this task's lease on the task queue until the task ends. Runs
+		in its own thread with its own database connection so that it keeps
+		going whilst the task itself is blocked."""
+
+		lease = self.config.get('NEOCORTEX_TASK_LEASE', 120)
+		db = None
+
+		while not self.heartbeat_stop.wait(lease / 3):
+			try:
+				if db is None:
+					db = self.db_connect()
+				curd = db.cursor()
+				curd.execute("UPDATE `task_queue` SET `lease_expires` = DATE_ADD(NOW(), INTERVAL %s SECOND) WHERE `task_id` = %s", (lease, self.task_id))
+				db.commit()
+			except Exception as ex:
+				self.logger.warning("task id %s failed to renew its lease: %s", self.task_id, ex)
+				db = None
+
+		if db is not None:
+			db.close()
+
+	def _requeue_task(self):
+		"""Releases this task's lease so that neocortex will start it again"""
+
+		self.heartbeat_stop.set()
+		self.journal.flush(commit=False)
+		self.curd.execute("UPDATE `task_queue` SET `lease_expires` = NULL, `attempts` = `attempts` - 1 WHERE `task_id` = %s", (self.task_id,))
+		self.curd.execute("UPDATE `tasks` SET `status` = %s WHERE `id` = %s", (self.STATUS_QUEUED, self.task_id))
+		self.db.commit()
+
 	def run(self, task_module, options):
 		"""Runs the task, passing this object to the task to provide access to
 		library routines and configuration options. Handles task closures and
@@ -70,10 +117,21 @@ class TaskHelper:
 		self.db = self.db_connect()
 		self.curd = self.db.cursor(mysql.cursors.DictCursor)
 		self.lib = Corpus(self.db, self.config)
+		self.journal = EventJournal(self.db, self.config.get('NEOCORTEX_EVENT_FLUSH_SIZE', 50), self.config.get('NEOCORTEX_EVENT_FLUSH_INTERVAL', 5))
+
+		## The buffer is only written when events are written, so make sure
+		## nothing is left in it whilst we wait for something slow
+		self.lib.before_wait = self._flush_events
+
+		## Keep our lease on the task queue alive whilst we're running
+		threading.Thread(target=self._heartbeat, daemon=True).start()
 
 		## Set the process name
 		setproctitle("neocortex task ID " + str(self.task_id) + " " + self.workflow_name)
 
+		## Let anyone watching the task know that it has started
+		self._publish({'action': 'task', 'status': self.STATUS_PROGRESS})
+
 		try:
 			task_module.run(self, options)
 			self._end_task()
@@ -86,6 +144,43 @@ class TaskHelper:
 		except Exception as ex:
 			self._log_exception(ex)
 			self._end_task(success=False)
+		finally:
+			## Make sure nothing is left in the event buffer however we leave
+			self.journal.flush()
+
+	def _flush_events(self):
+		"""Writes out any buffered events, e.g. before waiting for something
+		which could take hours"""
+
+		try:
+			self.journal.flush()
+		except Exception as ex:
+			## The events are kept and written later, so don't fail the task
+			self.logger.warning("task id %s failed to write buffered events: %s", self.task_id, str(ex))
+
+	def _publish(self, record):
+		"""Publishes a change to this task's events on Redis, both appending it
+		to the task's event list (for catching up) and to the task's channel
+		(for anyone watching the task status page). Returns the sequence number
+		of the record, which is its position in the list, or None if the record
+		could not be published."""
+
+		if not self.config.get('TASK_EVENT_STREAM', True):
+			return None
+
+		key = 'task/' + str(self.task_id) + '/events'
+		try:
+			record['seq'] = self.lib.rdb.rpush(key, json.dumps(record)) - 1
+
+			pipe = self.lib.rdb.pipeline()
+			pipe.expire(key, self.config.get('TASK_EVENT_STREAM_EXPIRE', 86400))
+			pipe.publish(key, json.dumps(record))
+			pipe.execute()
+		except Exception as ex:
+			self.logger.warning("task id %s failed to publish event: %s", self.task_id, ex)
+			return None
+
+		return record['seq']
 
 	def db_connect(self):
 		"""Returns a connection to the Cortex database"""
@@ -97,22 +192,20 @@ class TaskHelper:
 
 		exception_type = str(type(ex).__name__)
 		exception_message = str(ex)
-		self.curd.execute(
-			"INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())",
-			('neocortex.task', self.task_id, self.workflow_name + "." + 'exception', self.username, "The task failed because an exception was raised: " + exception_type + " - " + exception_message, self.STATUS_FAILED)
-		)
-		self.db.commit()
+		now = datetime.datetime.now()
+		self.journal.insert(('neocortex.task', self.task_id, self.workflow_name + "." + 'exception', self.username, "The task failed because an exception was raised: " + exception_type + " - " + exception_message, self.STATUS_FAILED, now, now))
+		self.journal.flush()
+		self._publish({'action': 'event', 'desc': "The task failed because an exception was raised: " + exception_type + " - " + exception_message, 'status': self.STATUS_FAILED})
 
 		self.logger.error('Unhandled exception caused task to end: %s', traceback.format_exc())
 
 	def _log_fatal_error(self, message):
 		"""Logs a fatal error into the events for this task"""
 
-		self.curd.execute(
-			"INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `status`, `start`, `end`) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())",
-			('neocortex.task', self.task_id, self.workflow_name + "." + 'exception', self.username, message, self.STATUS_FAILED)
-		)
-		self.db.commit()
+		now = datetime.datetime.now()
+		self.journal.insert(('neocortex.task', self.task_id, self.workflow_name + "." + 'exception', self.username, message, self.STATUS_FAILED, now, now))
+		self.journal.flush()
+		self._publish({'action': 'event', 'desc': message, 'status': self.STATUS_FAILED})
 
 	def event(self, name, description, success=True, oneshot=False, warning=False, changed=False):
 		"""Starts a new event within the tasks, closing an existing one if there was one"""
@@ -125,12 +218,17 @@ class TaskHelper:
 			self.end_event(success=success, warning=warning, changed=changed)
 
 		name = self.workflow_name + "." + name
-		self.curd.execute("INSERT INTO `events` (`source`, `related_id`, `name`, `username`, `desc`, `start`) VALUES (%s, %s, %s, %s, %s, NOW())", ('neocortex.task', self.task_id, name, self.username, description))
-		self.db.commit()
-		self.event_id = self.curd.lastrowid
+		now = datetime.datetime.now()
 
 		if oneshot:
-			self.end_event(success=success, warning=warning, changed=changed)
+			## Oneshot events are finished as soon as they start, so they
+			## can go straight in to the buffer
+			status = self._event_status(success, warning, changed)
+			self.journal.insert(('neocortex.task', self.task_id, name, self.username, description, status, now, now))
+			self._publish({'action': 'event', 'desc': description, 'status': status})
+		else:
+			self.event_id = self.journal.open(('neocortex.task', self.task_id, name, self.username, description, self.STATUS_PROGRESS, now, None))
+			self.event_seq = self._publish({'action': 'event', 'desc': description, 'status': self.STATUS_PROGRESS})
 
 		return True
 
@@ -140,8 +238,9 @@ class TaskHelper:
 		if self.event_id == -1:
 			return False
 
-		self.curd.execute("UPDATE `events` SET `desc` = %s WHERE `id` = %s", (description, self.event_id))
-		self.db.commit()
+		self.journal.update(self.event_id, desc=description)
+		if self.event_seq is not None:
+			self._publish({'action': 'update', 'event': self.event_seq, 'desc': str(description)})
 
 		return True
 
@@ -158,25 +257,30 @@ class TaskHelper:
 		if description is not None:
 			self.update_event(description)
 
+		status = self._event_status(success, warning, changed)
+		self.journal.update(self.event_id, status=status, end=datetime.datetime.now())
+		if self.event_seq is not None:
+			self._publish({'action': 'update', 'event': self.event_seq, 'status': status})
+		self.event_id = -1
+		self.event_seq = None
+
+		return True
+
+	def _event_status(self, success, warning, changed):
+		"""Returns the status for an event that is ending, keeping count of
+		those events which finished with warnings or failures"""
+
 		if success:
 			if warning:
-				# Keep count of events with warnings/failures
 				self.event_problems += 1
-				status = self.STATUS_WARNED
+				return self.STATUS_WARNED
 			elif changed:
-				status = self.STATUS_CHANGED
+				return self.STATUS_CHANGED
 			else:
-				status = self.STATUS_SUCCESS
+				return self.STATUS_SUCCESS
 		else:
-			# Keep count of events with warnings/failures
 			self.event_problems += 1
-			status = self.STATUS_FAILED
-
-		self.curd.execute("UPDATE `events` SET `status` = %s, `end` = NOW() WHERE `id` = %s", (status, self.event_id))
-		self.db.commit()
-		self.event_id = -1
-
-		return True
+			return self.STATUS_FAILED
 
 	def _end_task(self, success=True):
 		"""End the tasks, updaing it's status as appropriate. If any events within the
@@ -197,10 +301,15 @@ class TaskHelper:
 		else:
 			status = self.STATUS_FAILED
 
+		self.heartbeat_stop.set()
+		self.journal.flush(commit=False)
 		self.curd.execute("UPDATE `tasks` SET `status` = %s, `end` = NOW() WHERE `id` = %s", (status, self.task_id))
+		self.curd.execute("DELETE FROM `task_queue` WHERE `task_id` = %s", (self.task_id,))
 		self.db.commit()
 		self.event_problems = 0
 
+		self._publish({'action': 'task', 'status': status})
+
 		self.logger.info("task %s ended", self.task_id)
 
 	def get_problem_count(self):
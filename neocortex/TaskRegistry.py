@@ -0,0 +1,60 @@
+
+import imp
+import importlib
+import logging
+import os
+
+
+class TaskRegistry:
+	"""Keeps the compiled task modules for workflows and internal tasks loaded
+	in the neocortex process between submissions, so that workers forked from
+	it start with the task (and everything it imports) ready to go. A module is
+	only loaded again when its file changes on disk."""
+
+	def __init__(self, config):
+		"""Initialises the TaskRegistry object"""
+
+		self.config = config
+		self.logger = logging.getLogger('neocortex')
+
+		## Maps (task name, filename) to a (mtime, module) tuple
+		self.modules = {}
+
+	def load(self, task_name, task_file):
+		"""Returns the module for the given task, loading it if it has not been
+		loaded before or if the file has been modified since it was"""
+
+		mtime = os.stat(task_file).st_mtime
+		key = (task_name, task_file)
+
+		if key in self.modules and self.modules[key][0] == mtime:
+			return self.modules[key][1]
+
+		task_module = imp.load_source(task_name, task_file)
+		self.modules[key] = (mtime, task_module)
+		self.logger.info("loaded task module %s from %s", task_name, task_file)
+
+		return task_module
+
+	def preload(self):
+		"""Imports the modules listed in NEOCORTEX_PRELOAD_MODULES and loads
+		every workflow's task module. Failures are logged rather than raised
+		as they will be reported again when the task is submitted."""
+
+		for module_name in self.config.get('NEOCORTEX_PRELOAD_MODULES', []):
+			try:
+				importlib.import_module(module_name)
+			except Exception as ex:
+				self.logger.warning("failed to preload module %s: %s", module_name, ex)
+
+		workflows_dir = self.config['WORKFLOWS_DIR']
+		if not os.path.isdir(workflows_dir):
+			return
+
+		for workflow_name in sorted(os.listdir(workflows_dir)):
+			task_file = os.path.join(workflows_dir, workflow_name, "task.py")
+			if os.path.isfile(task_file):
+				try:
+					self.load(workflow_name, task_file)
+				except Exception as ex:
+					self.logger.warning("failed to preload workflow %s: %s", workflow_name, ex)
@@ -0,0 +1,45 @@
+import json
+import time
+
+# bin/neocortex modifies sys.path so these are importable.
+# pylint: disable=import-error
+from corpus.puppetdb_connector import NODE_FIELDS, PuppetDBConnector
+# pylint: enable=import-error
+
+def run(helper, _options):
+	"""
+	Takes a snapshot of the latest report status of every node in PuppetDB
+	and stores it in Redis (as the hash puppetdb/nodes, keyed by certname),
+	so that the web interface can show node statuses and statistics without
+	querying PuppetDB on every page load. See cortex.lib.puppet.
+	"""
+
+	# Create the PuppetDB object.
+	puppet = PuppetDBConnector(
+		host=helper.config["PUPPETDB_HOST"],
+		port=helper.config["PUPPETDB_PORT"],
+		ssl_cert=helper.config["PUPPETDB_SSL_CERT"],
+		ssl_key=helper.config["PUPPETDB_SSL_KEY"],
+		ssl_verify=helper.config["PUPPETDB_SSL_VERIFY"],
+	)
+
+	# Get the nodes from PuppetDB.
+	helper.event("puppetdb_snapshot", "Getting node statuses from PuppetDB")
+	nodes = puppet.query("nodes", query=json.dumps(["extract", NODE_FIELDS]))
+
+	# Build the new snapshot under a temporary key and then rename it over the
+	# old one, so that readers always see a complete snapshot. The snapshot
+	# expires so that a stale snapshot isn't used if this task stops running.
+	expire = int(helper.config.get("PUPPETDB_SNAPSHOT_EXPIRE", 600))
+	pipe = helper.lib.rdb.pipeline()
+	pipe.delete("puppetdb/nodes/new")
+	if nodes:
+		pipe.hset("puppetdb/nodes/new", mapping=dict((node["certname"], json.dumps(node)) for node in nodes))
+		pipe.rename("puppetdb/nodes/new", "puppetdb/nodes")
+		pipe.expire("puppetdb/nodes", expire)
+	else:
+		pipe.delete("puppetdb/nodes")
+	pipe.setex("puppetdb/nodes/updated", expire, time.time())
+	pipe.execute()
+
+	helper.end_event(description="Stored the status of " + str(len(nodes)) + " nodes from PuppetDB")
@@ -1,77 +1,241 @@
+import concurrent.futures
+import datetime
+import time
 
 import MySQLdb as mysql
-import requests
 
+# bin/neocortex modifies sys.path so these are importable.
+# pylint: disable=import-error
+from corpus.servicenow_api import ServiceNowAPI
+# pylint: enable=import-error
+
+CI_FIELDS = 'sys_id,sys_class_name,operational_status,u_number,name,short_description,u_environment,virtual,comments,os,sys_updated_on'
+CI_INSERT = 'INSERT INTO `sncache_cmdb_ci` (`sys_id`, `sys_class_name`, `name`, `operational_status`, `u_number`, `short_description`, `u_environment`, `virtual`, `comments`, `os`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
+CI_UPSERT = CI_INSERT + ' ON DUPLICATE KEY UPDATE `sys_class_name` = VALUES(`sys_class_name`), `name` = VALUES(`name`), `operational_status` = VALUES(`operational_status`), `u_number` = VALUES(`u_number`), `short_description` = VALUES(`short_description`), `u_environment` = VALUES(`u_environment`), `virtual` = VALUES(`virtual`), `comments` = VALUES(`comments`), `os` = VALUES(`os`)'
+
+# The details of the CI linked to each Puppet node that are included in its
+# ENC document (see cortex.lib.puppet.generate_node_config)
+ENC_CI_QUERY = 'SELECT `puppet_nodes`.`certname` AS `certname`, `sncache_cmdb_ci`.`u_environment` AS `u_environment`, `sncache_cmdb_ci`.`short_description` AS `short_description` FROM `puppet_nodes` JOIN `systems` ON `systems`.`id` = `puppet_nodes`.`id` LEFT JOIN `sncache_cmdb_ci` ON `sncache_cmdb_ci`.`sys_id` = `systems`.`cmdb_id` WHERE `systems`.`cmdb_id` IS NOT NULL'
+
+# The format of sys_updated_on values (which are in UTC) from ServiceNow
+SN_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def run(helper, options):
+	"""
+	Caches the CIs of the classes in CMDB_CACHED_CLASSES from ServiceNow.
+	If the 'incremental' option is set, only the CIs updated since the last
+	run are downloaded and updated in the cache, unless the cache has not
+	been fully reloaded within SN_CACHE_FULL_INTERVAL seconds (which is the
+	only way CIs deleted from ServiceNow are removed from the cache).
+	"""
 
-def run(helper, _options):
 	# Connect to the database
 	db = helper.db_connect()
 	curd = db.cursor(mysql.cursors.DictCursor)
 
-	# Initialise data dictionary
-	data = {}
-
-	# Download each of the configured tables
+	page_size = int(helper.config.get('SN_CACHE_PAGE_SIZE', 1000))
+
+	## Work out whether we can just fetch the changes since the last run
+	watermarks = get_watermarks(curd, helper.config['CMDB_CACHED_CLASSES'])
+	incremental = bool(options is not None and options.get('incremental', False))
+	if incremental:
+		curd.execute('SELECT `value` FROM `kv_settings` WHERE `key` = %s', ('sncache.last_full',))
+		last_full = curd.fetchone()
+		if last_full is None or float(last_full['value']) < time.time() - int(helper.config.get('SN_CACHE_FULL_INTERVAL', 86400)) or None in watermarks.values():
+			helper.event('servicenow_cache_full', 'A full reload of the cache is due', oneshot=True)
+			incremental = False
+
+	## Only ask for CIs updated since a little before the newest one we have
+	## seen, to allow for changes that were being saved when we last ran
+	queries = {}
 	for table in helper.config['CMDB_CACHED_CLASSES']:
-		# Start event
-		helper.event('servicenow_download_ci', 'Downloading "' + helper.config['CMDB_CACHED_CLASSES'][table] + '" data from ServiceNow instance ' + helper.config['SN_HOST'])
-
-		# Make the request to download all CI data using the table API, which can
-		# be limited to certain fields, and can resolve both choice value and
-		# choice label
-		r = requests.get('https://' + helper.config['SN_HOST'] + '/api/now/table/' + table + '?sysparm_fields=sys_id,sys_class_name,operational_status,u_number,name,short_description,u_environment,virtual,comments,os&sysparm_display_value=all', auth=(helper.config['SN_USER'], helper.config['SN_PASS']), headers={'Accept': 'application/json'})
+		if incremental:
+			since = datetime.datetime.strptime(watermarks[table], SN_DATETIME_FORMAT) - datetime.timedelta(seconds=int(helper.config.get('SN_CACHE_WATERMARK_OVERLAP', 300)))
+			queries[table] = 'sys_updated_on>=' + since.strftime(SN_DATETIME_FORMAT)
+		else:
+			queries[table] = ''
 
-		# Get the JSON returned from ServiceNow
-		data[table] = r.json()
+	# The shared client reuses connections, retries failed requests and
+	# limits how many requests we make at once
+	api = ServiceNowAPI.shared(helper.config)
 
-		# End event
-		helper.end_event(description='Downloaded "' + helper.config['CMDB_CACHED_CLASSES'][table] + '" data from ServiceNow')
+	# Remember what the Puppet ENC documents currently include from the CMDB,
+	# so that we can tell which of them change
+	enc_cis = get_enc_cis(curd)
 
-	helper.event('delete_cache', 'Deleting existing cache')
+	if not incremental:
+		helper.event('delete_cache', 'Deleting existing cache')
 
-	# Delete all the server CIs from the table (we must do this before we delete
-	# from the choices tables as there is a foreign key constraint)
-	curd.execute('DELETE FROM `sncache_cmdb_ci`;')
+		# Delete all the server CIs from the table (we must do this before we delete
+		# from the choices tables as there is a foreign key constraint). Nothing is
+		# committed until everything has been cached, so if anything fails the old
+		# data is retained.
+		curd.execute('DELETE FROM `sncache_cmdb_ci`;')
 
-	helper.end_event(description="Deleted existing cache")
+		helper.end_event(description="Deleted existing cache")
 
-	helper.event('servicenow_cache_ci', 'Caching ServiceNow CMDB data')
+	helper.event('servicenow_cache_ci', 'Downloading and caching ServiceNow CMDB data from ServiceNow instance ' + helper.config['SN_HOST'])
 
-	# Iterate over the results
 	total_records = 0
 	failed_records = 0
-	for table in data:
-		total_records = total_records + len(data[table]['result'])
-		for row in data[table]['result']:
-			virtual = False
-			if 'virtual' in row and row['virtual'] is not None and 'value' in row['virtual']:
-				if row['virtual']['value'] == 'true':
-					virtual = True
-
-			# Handle things that aren't common to everything
-			if 'u_environment' not in row:
-				row['u_environment'] = {'display_value': None, 'value': None}
-			else:
-				if 'display_value' not in row['u_environment']:
-					row['u_environment']['display_value'] = None
-			if 'os' not in row:
-				row['os'] = {'display_value': None, 'value': None}
-			else:
-				if 'display_value' not in row['os']:
-					row['os']['display_value'] = None
-
-			# Insert the information in to the database
-			try:
-				curd.execute('INSERT INTO `sncache_cmdb_ci` (`sys_id`, `sys_class_name`, `name`, `operational_status`, `u_number`, `short_description`, `u_environment`, `virtual`, `comments`, `os`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', (row['sys_id']['display_value'], row['sys_class_name']['display_value'], row['name']['display_value'], row['operational_status']['display_value'], row['u_number']['display_value'], row['short_description']['display_value'], row['u_environment']['display_value'], virtual, row['comments']['display_value'], row['os']['display_value']))
-			except Exception:
-				failed_records = failed_records + 1
+	chunk_size = int(helper.config.get('SN_CACHE_INSERT_CHUNK', 500))
+
+	# Download the first page of each of the configured tables at once. Each
+	# page starts after the last sys_id of the one before, so the pages of a
+	# table are downloaded in turn, and CIs added or deleted part way through
+	# don't cause others to be skipped.
+	pending = set()
+	for table in helper.config['CMDB_CACHED_CLASSES']:
+		pending.add(api.submit(download_page, api, table, queries[table], None, page_size))
+
+	# Cache each page as it arrives, rather than holding everything in memory
+	while pending:
+		done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			table, rows = future.result()
+
+			# A short page is the last one
+			if len(rows) == page_size:
+				pending.add(api.submit(download_page, api, table, queries[table], rows[-1]['sys_id']['value'], page_size))
+
+			total_records = total_records + len(rows)
+			failed_records = failed_records + cache_rows(curd, rows, chunk_size)
+
+			# Keep track of the newest change we've seen in each table
+			for row in rows:
+				updated = row.get('sys_updated_on', {}).get('value')
+				if updated and (watermarks[table] is None or updated > watermarks[table]):
+					watermarks[table] = updated
+
+		helper.update_event('Downloaded and cached ' + str(total_records) + ' records from ServiceNow instance ' + helper.config['SN_HOST'])
 
 	if failed_records == 0:
 		helper.end_event(description='Cached ' + str(total_records) + ' records')
 	else:
 		helper.end_event(description='Cached ' + str(total_records - failed_records) + ' out of ' + str(total_records) + ' records', success=True, warning=True)
 
+	# Remember where we got to, in the same transaction as the changes
+	for table in watermarks:
+		if watermarks[table] is not None:
+			curd.execute('REPLACE INTO `kv_settings` (`key`, `value`) VALUES (%s, %s)', ('sncache.watermark.' + table, watermarks[table]))
+	if not incremental:
+		curd.execute('REPLACE INTO `kv_settings` (`key`, `value`) VALUES (%s, %s)', ('sncache.last_full', str(time.time())))
+
 	# Commit to database
 	helper.event('servicenow_cache_ci', 'Saving cache to disk')
 	db.commit()
 	helper.end_event(description='Saved cache to disk')
+
+	# The Puppet ENC documents include details from the CMDB, so invalidate
+	# the cached copies of those whose CI has changed
+	changed_enc_cis = get_enc_cis(curd)
+	changed_certnames = [certname for certname in set(enc_cis) | set(changed_enc_cis) if enc_cis.get(certname) != changed_enc_cis.get(certname)]
+	if changed_certnames:
+		helper.lib.puppet_enc_invalidate(changed_certnames)
+
+def get_enc_cis(curd):
+	"""Returns a dictionary mapping the certname of each Puppet node linked
+	to a CI to the details of the CI in its ENC document"""
+
+	curd.execute(ENC_CI_QUERY)
+	return dict((row['certname'], (row['u_environment'], row['short_description'])) for row in curd.fetchall())
+
+def get_watermarks(curd, tables):
+	"""Returns a dictionary mapping each table to the newest sys_updated_on
+	value cached from it, or None if it isn't known"""
+
+	watermarks = dict((table, None) for table in tables)
+	for table in tables:
+		curd.execute('SELECT `value` FROM `kv_settings` WHERE `key` = %s', ('sncache.watermark.' + table,))
+		row = curd.fetchone()
+		if row is not None:
+			watermarks[table] = row['value']
+
+	return watermarks
+
+def download_page(api, table, query, after, page_size):
+	"""Downloads one page of the CIs matching the query from a table, in
+	order of sys_id starting after the sys_id given in after (or from the
+	start if it is None), returning the table and the list of CIs"""
+
+	# Page by sys_id rather than by offset, so that the pages don't overlap
+	# or leave gaps when CIs are added or deleted whilst we're downloading
+	conditions = [query] if query else []
+	if after is not None:
+		conditions.append('sys_id>' + after)
+	conditions.append('ORDERBYsys_id')
+
+	# Make the request to download the CI data using the table API, which can
+	# be limited to certain fields, and can resolve both choice value and
+	# choice label.
+	r = api.request('GET', '/api/now/table/' + table, params={
+		'sysparm_fields': CI_FIELDS,
+		'sysparm_display_value': 'all',
+		'sysparm_exclude_reference_link': 'true',
+		'sysparm_query': '^'.join(conditions),
+		'sysparm_limit': page_size,
+		'sysparm_no_count': 'true',
+	})
+	r.raise_for_status()
+
+	return (table, r.json()['result'])
+
+def ci_row(row):
+	"""Returns the values to insert in to sncache_cmdb_ci for a CI"""
+
+	virtual = False
+	if 'virtual' in row and row['virtual'] is not None and 'value' in row['virtual']:
+		if row['virtual']['value'] == 'true':
+			virtual = True
+
+	# Handle things that aren't common to everything
+	if 'u_environment' not in row:
+		row['u_environment'] = {'display_value': None, 'value': None}
+	else:
+		if 'display_value' not in row['u_environment']:
+			row['u_environment']['display_value'] = None
+	if 'os' not in row:
+		row['os'] = {'display_value': None, 'value': None}
+	else:
+		if 'display_value' not in row['os']:
+			row['os']['display_value'] = None
+
+	return (row['sys_id']['display_value'], row['sys_class_name']['display_value'], row['name']['display_value'], row['operational_status']['display_value'], row['u_number']['display_value'], row['short_description']['display_value'], row['u_environment']['display_value'], virtual, row['comments']['display_value'], row['os']['display_value'])
+
+def cache_rows(curd, rows, chunk_size=500):
+	"""Inserts (or updates) a page of CIs in the database, returning how
+	many of them couldn't be inserted"""
+
+	values = []
+	failed_records = 0
+	for row in rows:
+		try:
+			values.append(ci_row(row))
+		except Exception:
+			failed_records = failed_records + 1
+
+	# Insert the information in to the database a chunk at a time. We always
+	# upsert, as a CI that is changed whilst we're downloading can appear in
+	# an incremental update twice.
+	for index in range(0, len(values), chunk_size):
+		failed_records = failed_records + write_chunk(curd, values[index:index + chunk_size])
+
+	return failed_records
+
+def write_chunk(curd, values):
+	"""Upserts a list of rows with a single multi-row statement. If that
+	fails the list is split in half and each half written separately, so
+	that the bad rows are found and everything else is still written.
+	Returns the number of rows that couldn't be written."""
+
+	try:
+		## MySQLdb turns this in to a single multi-row INSERT
+		curd.executemany(CI_UPSERT, values)
+	except Exception:
+		if len(values) == 1:
+			return 1
+
+		middle = len(values) // 2
+		return write_chunk(curd, values[:middle]) + write_chunk(curd, values[middle:])
+
+	return 0
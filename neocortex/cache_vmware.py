@@ -1,30 +1,43 @@
 
-import signal
+import queue
+import threading
+import time
 
 import MySQLdb as mysql
 # pylint: disable=no-name-in-module
 from pyVmomi import vim
 # pylint: enable=no-name-in-module
 
-def sigalrm_handler(signum, frame):
-	"""
-	Handles the SIGALRM signal, which we use to interrupt a read should it
-	take a long time. This prevents this task from never completing and
-	never getting killed.
-	"""
-
-	# Raise an exception, which should interrupt and terminate
-	raise Exception("Timed out when communicating with vCenter")
+# The properties of each VM that are cached in vmware_cache_vm
+VM_PROPERTIES = [
+	"name", "config.uuid", "config.hardware.numCPU",
+	"config.hardware.memoryMB", "runtime.powerState",
+	"config.guestFullName", "config.guestId",
+	"config.version", "guest.hostName", "guest.ipAddress",
+	"config.annotation", "resourcePool", "guest.toolsRunningStatus",
+	"guest.toolsVersionStatus2", "config.template"
+]
+
+# The properties of each host that are summed up for the cluster statistics
+HOST_PROPERTIES = [
+	"hardware.memorySize", "hardware.cpuInfo.numCpuCores", "hardware.cpuInfo.hz",
+	"summary.quickStats.overallCpuUsage", "summary.quickStats.overallMemoryUsage"
+]
+
+VM_INSERT = "INSERT INTO `vmware_cache_vm` (`id`, `vcenter`, `name`, `uuid`, `numCPU`, `memoryMB`, `powerState`, `guestFullName`, `guestId`, `hwVersion`, `hostname`, `ipaddr`, `annotation`, `cluster`, `toolsRunningStatus`, `toolsVersionStatus`, `template`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+DATACENTER_INSERT = "INSERT INTO `vmware_cache_datacenters` (`id`, `name`, `vcenter`) VALUES (%s, %s, %s)"
+FOLDER_INSERT = "INSERT INTO `vmware_cache_folders` (`id`, `name`, `vcenter`, `did`, `parent`) VALUES (%s, %s, %s, %s, %s)"
+CLUSTER_INSERT = "INSERT INTO `vmware_cache_clusters` (`id`, `name`, `vcenter`, `did`, `ram`, `cores`, `cpuhz`, `cpu_usage`, `ram_usage`, `hosts`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
 
 def run(helper, options):
 	"""
 	Clears the necessary database tables and re-imports the data
-	from VMware. Performed as a single transaction, so if any part
-	of the import fails, the old data is retained.
+	from VMware. Each vCenter is downloaded at the same time in its
+	own thread and loaded in to copies of the cache tables as soon as it
+	has been downloaded. The copies are then swapped in all at once. If
+	any part of the import for a vCenter fails, its old data is retained.
 	"""
 
-	# pylint: disable=invalid-name,protected-access
-
 	## Get a lock so that nobody will attempt to update the database cache
 	## whilst we're running an update. We don't use MySQL locks because WRITE locks
 	## prevent reads whilst we're running (!??!) and that would break cortex/neocortex
@@ -45,284 +58,315 @@ def run(helper, options):
 		# Grab the timeout value from our configuration, or defaulting to
 		# an hour if none exists
 		if 'VMWARE_CACHE_UPDATE_TIMEOUT' in helper.config:
-			timeout_alarm = int(helper.config['VMWARE_CACHE_UPDATE_TIMEOUT'])
+			timeout = int(helper.config['VMWARE_CACHE_UPDATE_TIMEOUT'])
 		else:
-			timeout_alarm = 3600
+			timeout = 3600
+
+		skip_vms = bool(options is not None and 'skip_vms' in options and options['skip_vms'])
 
-		# Set up the signal handler for SIGALRM to interrupt reads (as
-		# PyVmomi doesn't appear to have a proper timeout on it's reads)
-		signal.signal(signal.SIGALRM, sigalrm_handler)
+		## Start downloading from every vCenter that appears in the configuration.
+		## PyVmomi doesn't appear to have a proper timeout on it's reads, so rather
+		## than interrupting a read we stop waiting for a vCenter once its time is
+		## up. The threads are daemons so a stuck read doesn't keep the task alive.
+		results = queue.Queue()
+		deadlines = {}
+		for key in list(helper.config['VMWARE'].keys()):
+			deadlines[key] = time.time() + timeout
+			threading.Thread(target=collect_instance, args=(helper, key, skip_vms, results), daemon=True).start()
 
-		# Create a list for instances that were successful
-		successful_instances = []
+		helper.event("vmware_cache_download", "Downloading information from " + str(len(deadlines)) + " VMware instance(s)", oneshot=True)
 
-		# Create dictionaries for VM data
-		vm_data = {}
-		dcs = {}
-		clusters = {}
-		folders = {}
+		# Statistics gathering setup
+		stats = {'vms': 0, 'linux': 0, 'winserver': 0, 'windesktop': 0, 'other': 0}
 
-		skip_vms = bool(options is not None and 'skip_vms' in options and options['skip_vms'])
+		## Load each vCenter in to the copies of the tables as it finishes downloading
+		create_new_tables(curd)
+		loaded = []
+		while deadlines:
+			try:
+				key, data, ex = results.get(timeout=max(0, min(deadlines.values()) - time.time()))
+			except queue.Empty:
+				# Give up on any vCenter that has run out of time
+				for key in [key for key in deadlines if deadlines[key] <= time.time()]:
+					del deadlines[key]
+					helper.event("vmware_cache_timeout", "Timed out when communicating with vCenter " + helper.config['VMWARE'][key]['hostname'], success=False, oneshot=True)
+				continue
+
+			# Ignore anything that arrives after we've given up on it
+			if key not in deadlines:
+				continue
+			del deadlines[key]
 
-		## For each vCenter that appears in the configuration
-		# pylint: disable=too-many-boolean-expressions
-		for key in list(helper.config['VMWARE'].keys()):
-			# Get the hostname
 			instance = helper.config['VMWARE'][key]
+			if ex is not None:
+				helper.event("vmware_cache_error", "Failed to download information from " + instance['hostname'] + ": " + str(ex), success=False, oneshot=True)
+				continue
 
-			helper.event("vmware_connect", "Connecting to VMware instance " + instance['hostname'])
+			helper.event("vmware_cache_data", "Caching downloaded data from " + instance['hostname'])
 			try:
-				si = helper.lib.vmware_smartconnect(key)
-				content = si.RetrieveContent()
-			except Exception:
-				helper.end_event(description="Failed to connect to instance " + instance['hostname'], success=False)
+				load_instance(curd, instance['hostname'], data, skip_vms)
+			except Exception as ex:
+				helper.end_event(description="Failed to cache information from " + instance['hostname'] + ": " + str(ex), success=False)
 				continue
-			else:
-				helper.end_event(description="Connected to instance " + instance['hostname'])
-
-				# Add the instance hostname to the successful instances.
-				successful_instances.append(instance["hostname"])
-
-				# If the task options don't say to skip VM information
-				if not skip_vms:
-					vm_properties = [
-						"name", "config.uuid", "config.hardware.numCPU",
-						"config.hardware.memoryMB", "runtime.powerState",
-						"config.guestFullName", "config.guestId",
-						"config.version", "guest.hostName", "guest.ipAddress",
-						"config.annotation", "resourcePool", "guest.toolsRunningStatus",
-						"guest.toolsVersionStatus2", "config.template"
-					]
-
-					## List VMs ##########
-					helper.event("vmware_cache_vm", "Downloading virtual machine information from " + instance['hostname'])
-
-					# Get the root of the VMware containers, and search for virtual machines
-					view = helper.lib.vmware_get_container_view(si, obj_type=[vim.VirtualMachine])
-
-					# Collect a subset of data on all VMs
-					signal.alarm(timeout_alarm)
-					vm_data_proxy = helper.lib.vmware_collect_properties(
-						si,
-						view_ref=view,
-						obj_type=vim.VirtualMachine,
-						path_set=vm_properties,
-						include_mors=True
-					)
-
-					# Start a vm_data section for this vCenter
-					vm_data[key] = {}
-
-					# Copy data from the proxy that pyVmomi returns to a non-proxied dictionary
-					for vm in vm_data_proxy:
-						# Get the managed object reference
-						moId = vm['obj']._moId
-
-						# Ensure we have a config.uuid (it's kind of essential...)
-						if 'config.uuid' not in vm:
-							# If we don't, ignore this VM
-							continue
-
-						# Start a vm_data section for this vm
-						vm_data[key][moId] = {}
-
-						# Put in the resource pool name rather than a Managed Object
-						if 'resourcePool' in vm:
-							vm_data[key][moId]['cluster'] = vm['resourcePool'].owner.name
-						else:
-							vm_data[key][moId]['cluster'] = 'None'
-
-						# Store moId
-						vm_data[key][moId]['_moId'] = moId
-
-						# Store attributes for the VM
-						for attr in ['name', 'config.uuid', 'config.hardware.numCPU', 'config.hardware.memoryMB', 'runtime.powerState', 'config.guestFullName', 'config.guestId', 'config.version', 'guest.hostName', 'guest.ipAddress', 'config.annotation', 'guest.toolsRunningStatus', 'guest.toolsVersionStatus2', 'config.template']:
-							if attr in vm:
-								vm_data[key][moId][attr] = vm[attr]
-							else:
-								# Put in blank strings for data we don't have
-								vm_data[key][moId][attr] = ''
-
-
-					# Finish the event
-					signal.alarm(0)
-					helper.end_event(description="Downloaded virtual machine information for " + instance['hostname'])
-
-				## List DCs ##########
-				helper.event("vmware_cache_dc", "Downloading datacenter and folder information from " + instance['hostname'])
-				signal.alarm(timeout_alarm)
-				dcs[key] = helper.lib.vmware_get_objects(content, [vim.Datacenter])
-
-				for datacenter in dcs[key]:
-					folders[datacenter._moId] = []
-					recurse_folder(datacenter.vmFolder, folders[datacenter._moId])
-
-				signal.alarm(0)
-				helper.end_event(description="Downloaded datacenter and folder information for " + instance['hostname'])
-
-				## List clusters ##########
-				helper.event("vmware_cache_cluster", "Downloading cluster information from " + instance['hostname'])
-				signal.alarm(timeout_alarm)
-				clusters_proxy = helper.lib.vmware_get_objects(content, [vim.ClusterComputeResource])
-				clusters[key] = {}
-				for cluster in clusters_proxy:
-					# Get the managed object reference
-					moId = cluster._moId
-
-					# Start a section for this cluster
-					clusters[key][moId] = {}
-
-					## Recurse up to find the data center
-					parent = cluster.parent
-					found = False
-
-					# Loop until we find the data center
-					while not found:
-						try:
-							# If we've got a Datacenter object as the parent
-							# then we've foudn what we're looking for
-							if isinstance(parent, vim.Datacenter):
-								clusterdc = parent._moId
-								found = True
-							else:
-								# Recurse to parent
-								parent = parent.parent
-						except Exception:
-							clusterdc = "Unknown"
-							break
-
-					# Calculate cluster statistics
-					total_ram = 0
-					total_cores = 0
-					total_hz = 0
-					total_cpu_usage = 0
-					total_ram_usage = 0
-
-					# We check for Nones here for hosts that are in maintenance mode, which return
-					# None rather than 0.
-					for host in cluster.host:
-						if host.hardware.memorySize is not None:
-							total_ram = total_ram + host.hardware.memorySize
-						if host.hardware.cpuInfo.numCpuCores is not None:
-							total_cores = total_cores + host.hardware.cpuInfo.numCpuCores
-						if host.hardware.cpuInfo.hz is not None:
-							total_hz = total_hz + host.hardware.cpuInfo.hz
-						if host.summary.quickStats.overallCpuUsage is not None:
-							total_cpu_usage = total_cpu_usage + host.summary.quickStats.overallCpuUsage
-						if host.summary.quickStats.overallMemoryUsage is not None:
-							total_ram_usage = total_ram_usage + host.summary.quickStats.overallMemoryUsage
-
-					# Put in our data
-					clusters[key][moId]['_moId'] = moId
-					clusters[key][moId]['name'] = cluster.name
-					clusters[key][moId]['dc'] = clusterdc
-					clusters[key][moId]['total_ram'] = total_ram
-					clusters[key][moId]['total_cores'] = total_cores
-					clusters[key][moId]['total_hz'] = total_hz
-					clusters[key][moId]['total_cpu_usage'] = total_cpu_usage
-					clusters[key][moId]['total_ram_usage'] = total_ram_usage
-					clusters[key][moId]['host_count'] = len(cluster.host)
-
-				# Finish the event
-				signal.alarm(0)
-				helper.end_event(description="Downloaded cluster machine information for " + instance['hostname'])
-
-		# Note: We delete the cache from the database after downloading all the data, so
-		# as to not lock the table and have it empty whilst the job is running
-
-		## Delete existing data from database
-		# Only delete where the instance was successfully connected.
-		for instance_hostname in successful_instances:
-			helper.event("delete_cache", "Deleting existing cache for instance " + instance_hostname)
-			curd.execute("START TRANSACTION")
-			curd.execute("DELETE FROM `vmware_cache_clusters` WHERE `vcenter` = %s", (instance_hostname, ))
-			curd.execute("DELETE FROM `vmware_cache_datacenters` WHERE `vcenter` = %s", (instance_hostname, ))
-			curd.execute("DELETE FROM `vmware_cache_folders` WHERE `vcenter` = %s", (instance_hostname, ))
-			if not skip_vms:
-				curd.execute("DELETE FROM `vmware_cache_vm` WHERE `vcenter` = %s", (instance_hostname, ))
-			helper.end_event(description="Deleted existing cache for instance " + instance_hostname)
 
-		# Statistics gathering setup
-		stats_vms = 0
-		stats_linux = 0
-		stats_winserver = 0
-		stats_windesktop = 0
-		stats_other = 0
+			loaded.append(instance['hostname'])
+			for stat in stats:
+				stats[stat] += data['stats'][stat]
 
-		## For each vCenter that appears in the configuration
-		for key in list(helper.config['VMWARE'].keys()):
-			# Get the hostname
-			instance = helper.config['VMWARE'][key]
+			helper.end_event(description="Cached information from " + instance['hostname'])
 
-			# Check that this instance was successful
-			if instance["hostname"] in successful_instances:
-
-				# Start the event
-				helper.event("vmware_cache_data", "Caching downloaded data from " + instance['hostname'])
-
-				# If the task options doesn't say to skip VM information
-				if not skip_vms:
-					# For each VM
-					for moId in vm_data[key]:
-						# Get the VM
-						vm = vm_data[key][moId]
-
-						# Put the VM in the database
-						curd.execute("INSERT INTO `vmware_cache_vm` (`id`, `vcenter`, `name`, `uuid`, `numCPU`, `memoryMB`, `powerState`, `guestFullName`, `guestId`, `hwVersion`, `hostname`, `ipaddr`, `annotation`, `cluster`, `toolsRunningStatus`, `toolsVersionStatus`, `template`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (vm['_moId'], instance['hostname'], vm['name'], vm['config.uuid'], vm['config.hardware.numCPU'], vm['config.hardware.memoryMB'], vm['runtime.powerState'], vm['config.guestFullName'], vm['config.guestId'], vm['config.version'], vm['guest.hostName'], vm['guest.ipAddress'], vm['config.annotation'], vm['cluster'], vm['guest.toolsRunningStatus'], vm['guest.toolsVersionStatus2'], vm['config.template']))
-
-						# Decide what kind of OS we have and update statistics
-						if vm['config.template'] == 0:
-							ostr = vm['config.guestId']
-							stats_vms += 1
-							if 'win' in ostr:
-								# Check between Windows Server and Desktop
-								if 'winLonghornGuest' in ostr or 'winLonghorn64Guest' in ostr or 'windows7Guest' in ostr or 'windows7_64Guest' in ostr or 'windows8Guest' in ostr or 'windows8_64Guest' in ostr or 'windows9Guest' in ostr or 'windows9_64Guest' in ostr:
-									stats_windesktop += 1
-								else:
-									stats_winserver += 1
-							elif "Linux" in ostr or 'linux' in ostr or 'rhel' in ostr or 'sles' in ostr or 'ubuntu' in ostr or 'centos' in ostr or 'debian' in ostr:
-								stats_linux += 1
-							else:
-								stats_other += 1
-
-				# For each Data Center, put it in the database (and the folders too)
-				for dc in dcs[key]:
-					curd.execute("INSERT INTO `vmware_cache_datacenters` (`id`, `name`, `vcenter`) VALUES (%s, %s, %s)", (dc._moId, dc.name, instance['hostname']))
-
-					for folder in folders[dc._moId]:
-						curd.execute("INSERT INTO `vmware_cache_folders` (`id`, `name`, `vcenter`, `did`, `parent`) VALUES (%s, %s, %s, %s, %s)", (folder['_moId'], folder['name'], instance['hostname'], dc._moId, folder['parent']))
-
-				# For each cluster
-				for moId in clusters[key]:
-					# Get the cluster
-					cluster = clusters[key][moId]
-
-					# Put the cluster in the database
-					curd.execute("INSERT INTO `vmware_cache_clusters` (`id`, `name`, `vcenter`, `did`, `ram`, `cores`, `cpuhz`, `cpu_usage`, `ram_usage`, `hosts`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (cluster['_moId'], cluster['name'], instance['hostname'], cluster['dc'], cluster['total_ram'], cluster['total_cores'], cluster['total_hz'], cluster['total_cpu_usage'], cluster['total_ram_usage'], cluster['host_count']))
-
-				helper.end_event(description="Cached information from " + instance['hostname'])
+		## Swap in the new tables, keeping the old data for any vCenter we
+		## couldn't download
+		helper.event("vmware_cache_swap", "Saving cache")
+		swap_new_tables(curd, loaded, skip_vms)
+		helper.end_event(description="Saved cache for " + str(len(loaded)) + " VMware instance(s)")
 
 		# Update statistics tables
 		helper.event("vmware_stats_update", "Updating statistics")
-		curd.execute("INSERT INTO `stats_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats_vms,))
-		curd.execute("INSERT INTO `stats_linux_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats_linux,))
-		curd.execute("INSERT INTO `stats_windows_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats_winserver,))
-		curd.execute("INSERT INTO `stats_desktop_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats_windesktop,))
-		curd.execute("INSERT INTO `stats_other_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats_other,))
+		curd.execute("INSERT INTO `stats_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats['vms'],))
+		curd.execute("INSERT INTO `stats_linux_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats['linux'],))
+		curd.execute("INSERT INTO `stats_windows_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats['winserver'],))
+		curd.execute("INSERT INTO `stats_desktop_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats['windesktop'],))
+		curd.execute("INSERT INTO `stats_other_vm_count` (`timestamp`, `value`) VALUES (NOW(), %s)", (stats['other'],))
+		tdb.commit()
 		helper.end_event(description="Statistics updated")
 
-		# Commit all the changes to the database
-		helper.event("vmware_cache_dc", "Saving cache to disk")
-		tdb.commit()
-		helper.end_event(description="Saved cache to disk")
+def collect_instance(helper, key, skip_vms, results):
+	"""
+	Downloads the VMs, datacenters, folders and clusters from one vCenter
+	and puts a (key, data, exception) tuple on the results queue. This runs
+	in its own thread, so it must not use the database or create events.
+	"""
 
-def recurse_folder(folder, folders):
-	children = folder.childEntity
+	try:
+		results.put((key, download_instance(helper, key, skip_vms), None))
+	except Exception as ex:
+		results.put((key, None, ex))
 
-	for child in children:
-		if isinstance(child, vim.Folder):
-			# pylint: disable=protected-access
-			folders.append({'_moId': child._moId, 'name': child.name, 'parent': folder._moId})
+def download_instance(helper, key, skip_vms):
+	"""
+	Downloads everything that is cached from the given vCenter, returning
+	a dictionary of the rows to insert for each table and the statistics.
+	"""
+
+	# pylint: disable=invalid-name,protected-access
+	instance = helper.config['VMWARE'][key]
+	si = helper.lib.vmware_smartconnect(key)
+
+	data = {'vms': [], 'datacenters': [], 'folders': [], 'clusters': [], 'stats': {'vms': 0, 'linux': 0, 'winserver': 0, 'windesktop': 0, 'other': 0}}
+
+	# If the task options don't say to skip VM information
+	if not skip_vms:
+		## List VMs ##########
+		# Get the root of the VMware containers, and search for virtual machines
+		view = helper.lib.vmware_get_container_view(si, obj_type=[vim.VirtualMachine])
+
+		# Collect a subset of data on all VMs
+		vm_data_proxy = helper.lib.vmware_collect_properties(
+			si,
+			view_ref=view,
+			obj_type=vim.VirtualMachine,
+			path_set=VM_PROPERTIES,
+			include_mors=True
+		)
+
+		# Copy data from the proxy that pyVmomi returns to a non-proxied dictionary
+		for vm in vm_data_proxy:
+			# Ensure we have a config.uuid (it's kind of essential...)
+			if 'config.uuid' not in vm:
+				# If we don't, ignore this VM
+				continue
+
+			# Store moId
+			vm['_moId'] = vm['obj']._moId
+
+			# Put in the resource pool name rather than a Managed Object
+			if 'resourcePool' in vm:
+				vm['cluster'] = vm['resourcePool'].owner.name
+			else:
+				vm['cluster'] = 'None'
+
+			data['vms'].append(vm_row(instance['hostname'], vm))
+			count_vm(data['stats'], vm)
+
+	## List DCs, folders and clusters ##########
+	# Collect the datacenters, folders, clusters and hosts in a single call,
+	# rather than reading each attribute of each object (and each parent
+	# and child) from vCenter one at a time, and build the tree from them
+	view = helper.lib.vmware_get_container_view(si, obj_type=[vim.ClusterComputeResource, vim.HostSystem, vim.Datacenter, vim.Folder])
+	inventory = helper.lib.vmware_collect_properties_by_type(si, view, {
+		vim.ClusterComputeResource: ['name', 'parent', 'host'],
+		vim.HostSystem: HOST_PROPERTIES,
+		vim.Datacenter: ['name', 'parent', 'vmFolder'],
+		vim.Folder: ['name', 'parent'],
+	})
+	view.Destroy()
+
+	for moId, datacenter in inventory[vim.Datacenter].items():
+		data['datacenters'].append((moId, datacenter['name'], instance['hostname']))
+
+	data['folders'] = folder_rows(instance['hostname'], inventory[vim.Datacenter], inventory[vim.Folder])
+	data['clusters'] = cluster_rows(instance['hostname'], inventory[vim.ClusterComputeResource], inventory[vim.HostSystem], inventory[vim.Datacenter], inventory[vim.Folder])
+
+	return data
+
+def count_vm(stats, vm):
+	"""Decides what kind of OS a VM has and updates the statistics"""
+
+	if vm.get('config.template', '') == 0:
+		ostr = vm.get('config.guestId', '')
+		stats['vms'] += 1
+		if 'win' in ostr:
+			# Check between Windows Server and Desktop
+			if 'winLonghornGuest' in ostr or 'winLonghorn64Guest' in ostr or 'windows7Guest' in ostr or 'windows7_64Guest' in ostr or 'windows8Guest' in ostr or 'windows8_64Guest' in ostr or 'windows9Guest' in ostr or 'windows9_64Guest' in ostr:
+				stats['windesktop'] += 1
+			else:
+				stats['winserver'] += 1
+		elif "Linux" in ostr or 'linux' in ostr or 'rhel' in ostr or 'sles' in ostr or 'ubuntu' in ostr or 'centos' in ostr or 'debian' in ostr:
+			stats['linux'] += 1
+		else:
+			stats['other'] += 1
+
+# The cache tables, and the statement used to fill each of them
+CACHE_TABLES = [
+	('vmware_cache_vm', VM_INSERT),
+	('vmware_cache_datacenters', DATACENTER_INSERT),
+	('vmware_cache_folders', FOLDER_INSERT),
+	('vmware_cache_clusters', CLUSTER_INSERT),
+]
+
+def create_new_tables(curd):
+	"""
+	Creates empty copies of the cache tables (named with a _new suffix) to
+	load vCenters in to with load_instance before they are swapped in with
+	swap_new_tables. Note that the DDL statements commit implicitly.
+	"""
+
+	for table, _ in CACHE_TABLES:
+		# Clear up after any previous run that died part way through
+		curd.execute("DROP TABLE IF EXISTS `" + table + "_new`, `" + table + "_old`")
+		curd.execute("CREATE TABLE `" + table + "_new` LIKE `" + table + "`")
+
+def load_instance(curd, vcenter, data, skip_vms):
+	"""
+	Loads the downloaded data for one vCenter in to the copies of the cache
+	tables. If this fails, anything loaded for the vCenter is removed again.
+	"""
+
+	rows = {'vmware_cache_vm': data['vms'], 'vmware_cache_datacenters': data['datacenters'], 'vmware_cache_folders': data['folders'], 'vmware_cache_clusters': data['clusters']}
+
+	try:
+		for table, insert in CACHE_TABLES:
+			# Keep the VMs for this vCenter if we've been told not to update them
+			if table == 'vmware_cache_vm' and skip_vms:
+				continue
+
+			## MySQLdb turns this in to multi-row INSERTs
+			if rows[table]:
+				curd.executemany(insert.replace("INSERT INTO `" + table + "`", "INSERT INTO `" + table + "_new`", 1), rows[table])
+	except Exception:
+		for table, _ in CACHE_TABLES:
+			curd.execute("DELETE FROM `" + table + "_new` WHERE `vcenter` = %s", (vcenter, ))
+		raise
+
+def swap_new_tables(curd, vcenters, skip_vms):
+	"""
+	Copies the rows for every vCenter which wasn't loaded (i.e. isn't in the
+	list of vcenters) from the cache tables in to their copies, and then swaps
+	all of the copies in with a single RENAME TABLE. Readers therefore never
+	wait on the load or see a half written cache.
+	"""
+
+	for table, _ in CACHE_TABLES:
+		# The VMs weren't loaded at all if we were told not to update them
+		if vcenters and not (table == 'vmware_cache_vm' and skip_vms):
+			curd.execute("INSERT INTO `" + table + "_new` SELECT * FROM `" + table + "` WHERE `vcenter` NOT IN (" + ", ".join(["%s"] * len(vcenters)) + ")", vcenters)
+		else:
+			curd.execute("INSERT INTO `" + table + "_new` SELECT * FROM `" + table + "`")
+
+	curd.execute("RENAME TABLE " + ", ".join("`" + table + "` TO `" + table + "_old`, `" + table + "_new` TO `" + table + "`" for table, _ in CACHE_TABLES))
+	curd.execute("DROP TABLE " + ", ".join("`" + table + "_old`" for table, _ in CACHE_TABLES))
+
+def write_instance(curd, vcenter, data, skip_vms):
+	"""
+	Replaces the cache for just one vCenter with the downloaded data, using
+	create_new_tables, load_instance and swap_new_tables.
+	"""
 
-			if len(child.childEntity) > 0:
-				recurse_folder(child, folders)
+	create_new_tables(curd)
+	load_instance(curd, vcenter, data, skip_vms)
+	swap_new_tables(curd, [vcenter], skip_vms)
+
+def vm_row(vcenter, vm):
+	"""Returns the values to insert in to vmware_cache_vm (see VM_INSERT) for
+	the given dictionary of VM properties, which should also contain the VM's
+	'_moId' and 'cluster' name"""
+
+	# Put in blank strings for data we don't have
+	values = [vm['_moId'], vcenter]
+	for attr in ['name', 'config.uuid', 'config.hardware.numCPU', 'config.hardware.memoryMB', 'runtime.powerState', 'config.guestFullName', 'config.guestId', 'config.version', 'guest.hostName', 'guest.ipAddress', 'config.annotation', 'cluster', 'guest.toolsRunningStatus', 'guest.toolsVersionStatus2', 'config.template']:
+		values.append(vm.get(attr, ''))
+
+	return tuple(values)
+
+def find_datacenter(parent, datacenters, folders):
+	"""Follows the chain of parents (managed objects) up through the folders
+	until a datacenter is found, returning its moId or 'Unknown'. The
+	datacenters and folders are dictionaries keyed by moId whose values
+	contain each object's 'parent'."""
+
+	# pylint: disable=protected-access
+	while parent is not None:
+		if parent._moId in datacenters:
+			return parent._moId
+		if parent._moId not in folders:
+			break
+		parent = folders[parent._moId].get('parent')
+
+	return "Unknown"
+
+def folder_rows(vcenter, datacenters, folders):
+	"""Returns the values to insert in to vmware_cache_folders (see
+	FOLDER_INSERT) for every folder beneath each datacenter's VM folder, given
+	dictionaries keyed by moId of the datacenters' and folders' properties"""
+
+	# pylint: disable=protected-access
+	children = {}
+	for moId, folder in folders.items():
+		if folder.get('parent') is not None:
+			children.setdefault(folder['parent']._moId, []).append(moId)
+
+	rows = []
+	for dc_moId, datacenter in datacenters.items():
+		if datacenter.get('vmFolder') is None:
+			continue
+
+		pending = [datacenter['vmFolder']._moId]
+		while pending:
+			parent_moId = pending.pop()
+			for moId in children.get(parent_moId, []):
+				rows.append((moId, folders[moId].get('name', ''), vcenter, dc_moId, parent_moId))
+				pending.append(moId)
+
+	return rows
+
+def cluster_rows(vcenter, clusters, hosts, datacenters, folders):
+	"""Returns the values to insert in to vmware_cache_clusters (see
+	CLUSTER_INSERT) given dictionaries keyed by moId of the properties of the
+	clusters ('name', 'parent' and 'host'), the hosts (HOST_PROPERTIES), the
+	datacenters and the folders"""
+
+	# pylint: disable=protected-access
+	rows = []
+	for moId, cluster in clusters.items():
+		# Calculate cluster statistics. We check for Nones here for hosts that
+		# are in maintenance mode, which return None rather than 0.
+		totals = dict((attr, 0) for attr in HOST_PROPERTIES)
+		for host in cluster.get('host', []):
+			for attr in HOST_PROPERTIES:
+				if hosts.get(host._moId, {}).get(attr) is not None:
+					totals[attr] = totals[attr] + hosts[host._moId][attr]
+
+		rows.append((moId, cluster.get('name', ''), vcenter, find_datacenter(cluster.get('parent'), datacenters, folders), totals['hardware.memorySize'], totals['hardware.cpuInfo.numCpuCores'], totals['hardware.cpuInfo.hz'], totals['summary.quickStats.overallCpuUsage'], totals['summary.quickStats.overallMemoryUsage'], len(cluster.get('host', []))))
+
+	return rows
@@ -0,0 +1,284 @@
+import time
+
+import MySQLdb as mysql
+# pylint: disable=no-name-in-module
+from pyVmomi import vim, vmodl
+# pylint: enable=no-name-in-module
+
+# bin/neocortex modifies sys.path so these are importable.
+# pylint: disable=import-error
+from neocortex.cache_vmware import (CLUSTER_INSERT, DATACENTER_INSERT,
+                                    FOLDER_INSERT, HOST_PROPERTIES, VM_INSERT,
+                                    VM_PROPERTIES, cluster_rows, folder_rows,
+                                    vm_row, write_instance)
+# pylint: enable=import-error
+
+def run(helper, _options):
+	"""
+	Keeps the VMware cache up to date by having each vCenter tell us about
+	changes to VMs, clusters, hosts, datacenters and folders as they happen
+	and applying just those changes, rather than downloading everything and
+	re-importing it. Each vCenter is loaded in full when the task starts. The
+	task ends after VMWARE_CACHE_SYNC_DURATION seconds, so it should be
+	started again regularly (see bin/sync_vmware_cache).
+	"""
+
+	duration = int(helper.config.get('VMWARE_CACHE_SYNC_DURATION', 3600))
+	wait = int(helper.config.get('VMWARE_CACHE_SYNC_WAIT', 2))
+
+	## Use a /seperate/ connection to the database so that the helper object
+	## can still make changes to mysql whilst we're applying changes
+	tdb = helper.db_connect()
+
+	syncs = []
+	for key in list(helper.config['VMWARE'].keys()):
+		sync = VMwareCacheSync(helper, key, tdb)
+
+		helper.event("vmware_sync_load", "Loading the cache for VMware instance " + sync.vcenter)
+		try:
+			sync.connect()
+			changes = sync.update(wait)
+		except Exception as ex:
+			helper.end_event(description="Failed to load the cache for VMware instance " + sync.vcenter + ": " + str(ex), success=False)
+		else:
+			helper.end_event(description="Loaded " + str(changes) + " objects in to the cache for VMware instance " + sync.vcenter)
+
+		# Failed instances are still kept so that we reconnect to them later
+		syncs.append(sync)
+
+	helper.event("vmware_sync", "Applying changes from VMware to the cache")
+	total_changes = 0
+	deadline = time.time() + duration
+
+	while time.time() < deadline:
+		for sync in syncs:
+			try:
+				if sync.property_collector is None:
+					# Don't retry a failed instance more than once a minute
+					if time.time() - sync.failed_at < 60:
+						continue
+					sync.connect()
+
+				total_changes += sync.update(wait)
+			except Exception as ex:
+				helper.event("vmware_sync_error", "Lost connection to VMware instance " + sync.vcenter + ": " + str(ex), oneshot=True, warning=True)
+				helper.event("vmware_sync", "Applying changes from VMware to the cache")
+				sync.disconnect()
+
+		# Don't spin if every instance is unavailable
+		if all(sync.property_collector is None for sync in syncs):
+			time.sleep(wait)
+
+	for sync in syncs:
+		sync.disconnect()
+
+	helper.end_event(description="Applied " + str(total_changes) + " changes from VMware to the cache")
+
+class VMwareCacheSync:
+	"""Maintains the cache for one vCenter from the updates sent by a property
+	collector filter on everything we cache. The properties of each object are
+	kept in memory so that the rows for an object can be rebuilt when only
+	some of its properties change."""
+
+	# The properties we watch on each type of object
+	PROPERTIES = [
+		(vim.VirtualMachine, VM_PROPERTIES),
+		(vim.HostSystem, HOST_PROPERTIES),
+		(vim.ComputeResource, ['name', 'parent', 'host']),
+		(vim.ResourcePool, ['owner']),
+		(vim.Datacenter, ['name', 'parent', 'vmFolder']),
+		(vim.Folder, ['name', 'parent']),
+	]
+
+	def __init__(self, helper, tag, db):
+		self.helper = helper
+		self.tag = tag
+		self.vcenter = helper.config['VMWARE'][tag]['hostname']
+		self.db = db
+		self.property_collector = None
+		self.version = ''
+		self.failed_at = 0
+		self.objects = {}
+
+	def connect(self):
+		"""Connects to the vCenter and creates a filter on everything we cache.
+		The next update will contain everything, i.e. a full load."""
+
+		service_instance = self.helper.lib.vmware_smartconnect(self.tag)
+		content = service_instance.RetrieveContent()
+
+		view = content.viewManager.CreateContainerView(content.rootFolder, [obj_type for obj_type, _ in self.PROPERTIES], True)
+
+		# Use our own property collector so that we don't interfere with, or
+		# see the updates of, anything else using this session
+		self.property_collector = content.propertyCollector.CreatePropertyCollector()
+		self.property_collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+			objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view', skip=False, type=vim.view.ContainerView)])],
+			propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set) for obj_type, path_set in self.PROPERTIES]
+		), True)
+
+		self.version = ''
+		self.objects = {
+			'vm': {}, 'host': {}, 'cluster': {}, 'compute': {},
+			'pool': {}, 'datacenter': {}, 'folder': {}
+		}
+
+	def disconnect(self):
+		"""Throws away the property collector, so that the next call to connect
+		starts again with a full load"""
+
+		if self.property_collector is not None:
+			try:
+				self.property_collector.Destroy()
+			except Exception:
+				pass
+
+		self.property_collector = None
+		self.failed_at = time.time()
+
+	def _kind(self, obj):
+		"""Returns which dictionary of self.objects the object belongs in"""
+
+		# pylint: disable=too-many-return-statements
+		if isinstance(obj, vim.VirtualMachine):
+			return 'vm'
+		if isinstance(obj, vim.HostSystem):
+			return 'host'
+		if isinstance(obj, vim.ClusterComputeResource):
+			return 'cluster'
+		if isinstance(obj, vim.ComputeResource):
+			return 'compute'
+		if isinstance(obj, vim.ResourcePool):
+			return 'pool'
+		if isinstance(obj, vim.Datacenter):
+			return 'datacenter'
+		return 'folder'
+
+	def update(self, wait):
+		"""Waits up to wait seconds for changes from vCenter and applies any to
+		the database. Returns the number of objects that changed."""
+
+		# pylint: disable=invalid-name,protected-access
+		full = self.version == ''
+		changed = {'vm': set(), 'host': set(), 'cluster': set(), 'compute': set(), 'pool': set(), 'datacenter': set(), 'folder': set()}
+		removed_vms = set()
+		count = 0
+
+		while True:
+			update_set = self.property_collector.WaitForUpdatesEx(self.version, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait, maxObjectUpdates=1000))
+			if update_set is None:
+				break
+
+			self.version = update_set.version
+			for filter_set in update_set.filterSet:
+				for object_set in filter_set.objectSet:
+					kind = self._kind(object_set.obj)
+					moId = object_set.obj._moId
+					changed[kind].add(moId)
+					count += 1
+
+					if object_set.kind == 'leave':
+						self.objects[kind].pop(moId, None)
+						if kind == 'vm':
+							removed_vms.add(moId)
+						continue
+
+					properties = self.objects[kind].setdefault(moId, {'_moId': moId})
+					for change in object_set.changeSet:
+						if change.op == 'assign':
+							properties[change.name] = change.val
+						else:
+							properties.pop(change.name, None)
+
+			# Keep going until we have everything if vCenter split it up
+			if not update_set.truncated:
+				break
+
+			wait = 0
+
+		if count == 0:
+			return 0
+
+		# The cluster name of a VM comes from its resource pool's owner, so if
+		# either of those change then the VMs in those pools need updating
+		if changed['pool'] or changed['cluster'] or changed['compute']:
+			for moId, vm in self.objects['vm'].items():
+				pool = vm.get('resourcePool')
+				if pool is not None and (pool._moId in changed['pool'] or (self.objects['pool'].get(pool._moId, {}).get('owner') is not None and self.objects['pool'][pool._moId]['owner']._moId in changed['cluster'] | changed['compute'])):
+					changed['vm'].add(moId)
+
+		self._apply(full, changed, removed_vms)
+
+		return count
+
+	def _cluster_name(self, vm):
+		"""Returns the name of the cluster (or standalone host) a VM is in"""
+
+		# pylint: disable=protected-access
+		pool = self.objects['pool'].get(vm['resourcePool']._moId, {}) if vm.get('resourcePool') is not None else {}
+		if pool.get('owner') is None:
+			return 'None'
+
+		owner = self.objects['cluster'].get(pool['owner']._moId) or self.objects['compute'].get(pool['owner']._moId) or {}
+		return owner.get('name', 'None')
+
+	def _apply(self, full, changed, removed_vms):
+		"""Writes the rows for everything that changed in to the cache"""
+
+		vm_rows = []
+		for moId in changed['vm']:
+			vm = self.objects['vm'].get(moId)
+
+			# Ensure we have a config.uuid (it's kind of essential...)
+			if vm is not None and vm.get('config.uuid'):
+				vm = dict(vm, cluster=self._cluster_name(vm))
+				vm_rows.append(vm_row(self.vcenter, vm))
+
+		# Nearly any change to the inventory can affect which datacenter a
+		# folder or cluster is in, so rebuild all of those for the vCenter
+		rebuild_folders = changed['datacenter'] or changed['folder']
+		rebuild_clusters = changed['cluster'] or changed['datacenter'] or changed['folder']
+
+		# The usage statistics of hosts change all the time, so when only
+		# hosts have changed just rebuild the clusters that they're in (a
+		# host moving between clusters changes the clusters themselves)
+		host_clusters = {}
+		if not rebuild_clusters and changed['host']:
+			# pylint: disable=protected-access
+			host_clusters = dict((moId, cluster) for moId, cluster in self.objects['cluster'].items() if any(host._moId in changed['host'] for host in cluster.get('host', [])))
+
+		## Don't write to the cache whilst the full update task is running
+		with self.helper.lib.rdb.lock('lock/update_vmware_cache', timeout=1800, sleep=1):
+			curd = self.db.cursor(mysql.cursors.DictCursor)
+
+			if full:
+				# Swap in everything for this vCenter in one go, which also
+				# clears out anything that was removed whilst we weren't watching
+				write_instance(curd, self.vcenter, {
+					'vms': vm_rows,
+					'datacenters': [(moId, datacenter.get('name', ''), self.vcenter) for moId, datacenter in self.objects['datacenter'].items()],
+					'folders': folder_rows(self.vcenter, self.objects['datacenter'], self.objects['folder']),
+					'clusters': cluster_rows(self.vcenter, self.objects['cluster'], self.objects['host'], self.objects['datacenter'], self.objects['folder'])
+				}, False)
+				return
+
+			if removed_vms:
+				curd.executemany("DELETE FROM `vmware_cache_vm` WHERE `id` = %s AND `vcenter` = %s", [(moId, self.vcenter) for moId in removed_vms])
+
+			if vm_rows:
+				curd.executemany(VM_INSERT.replace("INSERT INTO", "REPLACE INTO", 1), vm_rows)
+
+			if rebuild_folders:
+				curd.execute("DELETE FROM `vmware_cache_datacenters` WHERE `vcenter` = %s", (self.vcenter,))
+				curd.execute("DELETE FROM `vmware_cache_folders` WHERE `vcenter` = %s", (self.vcenter,))
+				curd.executemany(DATACENTER_INSERT, [(moId, datacenter.get('name', ''), self.vcenter) for moId, datacenter in self.objects['datacenter'].items()])
+				curd.executemany(FOLDER_INSERT, folder_rows(self.vcenter, self.objects['datacenter'], self.objects['folder']))
+
+			if rebuild_clusters:
+				curd.execute("DELETE FROM `vmware_cache_clusters` WHERE `vcenter` = %s", (self.vcenter,))
+				curd.executemany(CLUSTER_INSERT, cluster_rows(self.vcenter, self.objects['cluster'], self.objects['host'], self.objects['datacenter'], self.objects['folder']))
+			elif host_clusters:
+				curd.executemany("DELETE FROM `vmware_cache_clusters` WHERE `id` = %s AND `vcenter` = %s", [(moId, self.vcenter) for moId in host_clusters])
+				curd.executemany(CLUSTER_INSERT, cluster_rows(self.vcenter, host_clusters, self.objects['host'], self.objects['datacenter'], self.objects['folder']))
+
+			self.db.commit()
@@ -1,13 +1,21 @@
 
+import concurrent.futures
+
 import MySQLdb as mysql
 
 # bin/neocortex modifies sys.path so these are importable.
 # pylint: disable=import-error
 from corpus.puppetdb_connector import PuppetDBConnector
+from corpus.servicenow_api import ServiceNowAPI
 from corpus.sn_puppet_connector import SNPuppetConnector
 # pylint: enable=import-error
 
 def run(helper, _options):
+	"""
+	Pushes the facts of every Puppet node linked to a CI to ServiceNow. The
+	nodes are pushed concurrently, using the workers of the shared
+	ServiceNow client.
+	"""
 
 	# Connect to database.
 	db = helper.db_connect()
@@ -21,44 +29,72 @@ def run(helper, _options):
 		ssl_verify=helper.config['PUPPETDB_SSL_VERIFY'],
 	)
 
-	# Create the ServiceNow connector object.
-	sn_connector = SNPuppetConnector(
-		sn_host=helper.config['SN_HOST'],
-		sn_version='v1',
-		sn_user=helper.config['SN_USER'],
-		sn_pass=helper.config['SN_PASS'],
-		puppet_connector=puppet_connector,
-	)
-
+	# The shared ServiceNow client, which limits how many requests we make at once
+	api = ServiceNowAPI.shared(helper.config)
 
 	helper.event('puppet_nodes', 'Getting nodes from Puppet')
 	nodes = puppet_connector.get_nodes()
 	helper.end_event(description="Received nodes from Puppet")
 
+	# Use the cortex database to get the sys_id of every node up front, as
+	# the pushes happen in other threads
+	curd = db.cursor(mysql.cursors.DictCursor)
+	curd.execute('SELECT `name`, `cmdb_id`, `puppet_certname`, `vmware_ram` FROM `systems_info_view` WHERE `puppet_certname` IS NOT NULL')
+	systems = {}
+	for row in curd.fetchall():
+		systems.setdefault(row['puppet_certname'], row)
+	curd.close()
+
+	futures = {}
 	for node in nodes:
-		helper.event('push_facts_to_service_now', 'Pushing facts for node ' + str(node.name) + ' to ServiceNow')
+		result = systems.get(node.name)
 
-		# Use the cortex database to get the node sys_id.
-		curd = db.cursor(mysql.cursors.DictCursor)
-		curd.execute('SELECT `name`, `cmdb_id`, `puppet_certname`, `vmware_ram` FROM `systems_info_view` WHERE `puppet_certname`=%s', (node.name,))
-		result = curd.fetchone()
-		curd.close()
 		# Ensure we have a result.
-		if result is not None:
-			cmdb_id = result["cmdb_id"]
-
-			# If there is no CMDB id then there would be nothing to update.
-			if cmdb_id is not None:
-				try:
-					# Push the facts
-					sn_connector.push_facts(node, cmdb_id, vmware_ram=result["vmware_ram"]) # Specifically push the VMware ram from the Cortex DB.
-				except Exception as e:
-					helper.end_event(description='Failed to push facts for node ' + str(node.name) + ' Exception: ' + str(e), success=False)
-				else:
-					helper.end_event(description='Successfully pushed facts for node ' + str(node.name) + ' with CMDB ID ' + str(cmdb_id))
-			else:
-				helper.end_event(description='CMDB ID not found for node ' + str(node.name) + ' in the Cortex DB', success=False)
-
-		else:
+		if result is None:
 			# No result found - the certname of this node is not in the cortex db.
+			helper.event('push_facts_to_service_now', 'Pushing facts for node ' + str(node.name) + ' to ServiceNow')
 			helper.end_event(description='No result for node ' + str(node.name) + ' in the Cortex DB.', success=False)
+
+		# If there is no CMDB id then there would be nothing to update.
+		elif result['cmdb_id'] is None:
+			helper.event('push_facts_to_service_now', 'Pushing facts for node ' + str(node.name) + ' to ServiceNow')
+			helper.end_event(description='CMDB ID not found for node ' + str(node.name) + ' in the Cortex DB', success=False)
+
+		else:
+			# Specifically push the VMware ram from the Cortex DB.
+			future = api.submit(push_node_facts, helper, puppet_connector, api, node, result['cmdb_id'], result['vmware_ram'])
+			futures[future] = (node, result['cmdb_id'])
+
+	# Record the outcome of each push as it finishes
+	for future in concurrent.futures.as_completed(futures):
+		node, cmdb_id = futures[future]
+		helper.event('push_facts_to_service_now', 'Pushing facts for node ' + str(node.name) + ' to ServiceNow')
+
+		try:
+			pushed = future.result()
+		except Exception as e:
+			helper.end_event(description='Failed to push facts for node ' + str(node.name) + ' Exception: ' + str(e), success=False)
+		else:
+			if pushed > 0:
+				helper.end_event(description='Successfully pushed ' + str(pushed) + ' changed record(s) for node ' + str(node.name) + ' with CMDB ID ' + str(cmdb_id))
+			else:
+				helper.end_event(description='Facts for node ' + str(node.name) + ' with CMDB ID ' + str(cmdb_id) + ' are unchanged')
+
+def push_node_facts(helper, puppet_connector, api, node, cmdb_id, vmware_ram):
+	"""Pushes the facts (only those that have changed since the last push)
+	of one node to ServiceNow, returning the number of records pushed. Each
+	push has its own connector, as the connector keeps the state of the
+	push it is doing."""
+
+	sn_connector = SNPuppetConnector(
+		sn_host=helper.config['SN_HOST'],
+		sn_version='v1',
+		sn_user=helper.config['SN_USER'],
+		sn_pass=helper.config['SN_PASS'],
+		puppet_connector=puppet_connector,
+		rdb=helper.lib.rdb,
+		fingerprint_expire=helper.config.get('SN_PUPPET_FINGERPRINT_EXPIRE', 604800),
+		service_now=api,
+	)
+
+	return sn_connector.push_facts(node, cmdb_id, vmware_ram=vmware_ram)
@@ -18,8 +18,14 @@ def run(helper, _options):
 
 	helper.end_event(description="Expiration checking complete - " + str(len(systems)) + " found expired")
 
+	# Find the VMs for all of the systems on each vCenter at once (systems
+	# which aren't in the VMware cache have no vCenter and can't be found)
+	vms = {}
+	for vcenter in set(row['vmware_vcenter'] for row in systems if row['vmware_vcenter'] is not None):
+		vms[vcenter] = helper.lib.vmware_get_vms_by_uuid([row['vmware_uuid'] for row in systems if row['vmware_vcenter'] == vcenter], vcenter)
+
 	for row in systems:
-		vm = helper.lib.vmware_get_vm_by_uuid(row['vmware_uuid'], row['vmware_vcenter'])
+		vm = vms.get(row['vmware_vcenter'], {}).get(row['vmware_uuid'])
 		if vm is not None:
 			if vm.runtime.powerState == vim.VirtualMachine.PowerState.poweredOn:
 				failed = False
@@ -1,6 +1,11 @@
-from flask import Response, abort, make_response, request
+import hashlib
+import json
+import time
+
+from flask import Response, abort, make_response, request, stream_with_context
 
 import cortex.lib.core
+import cortex.lib.puppet
 import cortex.lib.systems
 from cortex import app
 
@@ -29,6 +34,65 @@ def api_systems_csv():
 
 ################################################################################
 
+@app.route('/api/puppet/enc')
+def api_puppet_enc_export():
+	"""Returns the YAML associated with every node, or with just the nodes
+	that may have changed since the UNIX timestamp given in the 'since'
+	parameter, as newline-delimited JSON objects (one per node). Nodes that
+	have been removed since then are marked as removed, and nodes whose YAML
+	couldn't be generated are marked as failed. The X-Export-Full header is
+	set if every node is included (so any other node has been removed), and
+	the last object marks the end of the export."""
+
+	# The request should contain a parameter in the headers which contains
+	# the authentication pre-shared key. Validate this:
+	if 'X-Auth-Token' not in request.headers:
+		app.logger.warn('auth_token missing from Puppet ENC export API request')
+		return abort(401)
+	if request.headers['X-Auth-Token'] != app.config['ENC_API_AUTH_TOKEN']:
+		app.logger.warn('Incorrect auth_token on request to Puppet ENC export API')
+		return abort(401)
+
+	# Check that we've got a valid time if we've been given one
+	since = request.args.get('since', None)
+	if since is not None:
+		try:
+			since = float(since)
+		except ValueError:
+			app.logger.warn('Invalid since parameter presented to Puppet ENC export API (since: ' + since + ')')
+			abort(400)
+
+	# The client can ask for what has changed since the start of this export
+	# next time, so tell it when that was (less a minute, for changes that
+	# were being committed as we started and clock differences between hosts)
+	generated_at = time.time() - 60
+
+	# Work out which nodes we need to send
+	certnames = None
+	if since is not None:
+		certnames = cortex.lib.puppet.get_changed_node_configs(since)
+
+	def ndjson_stream():
+		found = set()
+		for certname, node_yaml in cortex.lib.puppet.generate_node_configs(certnames):
+			found.add(certname)
+			if node_yaml is None:
+				yield json.dumps({'certname': certname, 'failed': True}) + "\n"
+			else:
+				yield json.dumps({'certname': certname, 'etag': hashlib.sha1(node_yaml.encode('utf-8')).hexdigest(), 'yaml': node_yaml}) + "\n"
+
+		# Any node that has changed but no longer exists has been removed
+		if certnames is not None:
+			for certname in sorted(set(certnames) - found):
+				yield json.dumps({'certname': certname, 'removed': True}) + "\n"
+
+		# Let the client know it has got all of the export
+		yield json.dumps({'complete': True}) + "\n"
+
+	return Response(stream_with_context(ndjson_stream()), mimetype="application/x-ndjson", headers={'X-Generated-At': str(generated_at), 'X-Export-Full': '1' if certnames is None else '0'})
+
+################################################################################
+
 @app.route('/api/puppet/enc/<certname>')
 def api_puppet_enc(certname):
 	"""Returns the YAML associated with the given node."""
@@ -58,7 +122,10 @@ def api_puppet_enc(certname):
 	# many rows in the database...
 	#cortex.lib.core.log(__name__, "api.puppet.enc", "Generated Puppet ENC YAML for " + certname)
 
-	# Make a response and return it
+	# Make a response and return it. The ETag is the SHA-1 of the document, so
+	# a client that already has the current document (bin/cortex-enc-wrapper
+	# sends the SHA-1 of its cached copy in If-None-Match) just gets a 304
 	r = make_response(node_yaml)
 	r.headers['Content-Type'] = "application/x-yaml"
-	return r
+	r.set_etag(hashlib.sha1(node_yaml.encode('utf-8')).hexdigest())
+	return r.make_conditional(request)
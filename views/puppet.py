@@ -134,6 +134,7 @@ def puppet_enc_edit(node):
 		# Update the system
 		curd.execute('UPDATE `puppet_nodes` SET `env` = %s, `classes` = %s, `variables` = %s, `include_default` = %s WHERE `certname` = %s', (environment, classes, variables, include_default, system['puppet_certname']))
 		g.db.commit()
+		cortex.lib.puppet.invalidate_node_config(system['puppet_certname'])
 		cortex.lib.core.log(__name__, "puppet.config.changed", "Puppet node configuration updated for '" + system['puppet_certname'] + "'")
 
 		# Redirect back to the systems page
@@ -191,6 +192,7 @@ def puppet_enc_default():
 		# Update the system
 		curd.execute('REPLACE INTO `kv_settings` (`key`, `value`) VALUES ("puppet.enc.default", %s)', (classes,))
 		g.db.commit()
+		cortex.lib.puppet.invalidate_node_config()
 
 		cortex.lib.core.log(__name__, "puppet.defaultconfig.changed", "Puppet default configuration updated")
 		# Redirect back
@@ -453,9 +455,9 @@ def puppet_search():
 	curd.execute('''SELECT DISTINCT `puppet_nodes`.`certname` AS `certname`, `puppet_nodes`.`env` AS `env`, `systems`.`id` AS `id`, `systems`.`name` AS `name`  FROM `puppet_nodes` LEFT JOIN `systems` ON `puppet_nodes`.`id` = `systems`.`id` WHERE `puppet_nodes`.`classes` LIKE %s OR `puppet_nodes`.`variables` LIKE %s ORDER BY `puppet_nodes`.`certname`''', (query, query))
 	results = curd.fetchall()
 
-	# Get node statuses
+	# Get the statuses of just the nodes we found
 	try:
-		statuses = cortex.lib.puppet.puppetdb_get_node_statuses()
+		statuses = cortex.lib.puppet.puppetdb_get_node_statuses(node_names=[row['certname'] for row in results])
 	except Exception as e:
 		return stderr("Unable to connect to PuppetDB", "Unable to connect to the Puppet database. The error was: " + type(e).__name__ + " - " + str(e))
 
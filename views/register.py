@@ -3,6 +3,7 @@ import requests
 from flask import abort, g, jsonify, request
 
 import cortex.lib.core
+import cortex.lib.puppet
 import cortex.lib.systems
 from cortex import app
 from cortex.corpus import Corpus
@@ -177,6 +178,7 @@ def api_register_system():
 			curd = g.db.cursor(mysql.cursors.DictCursor)
 			curd.execute("INSERT INTO `puppet_nodes` (`id`, `certname`, `env`) VALUES (%s, %s, %s)", (system['id'], fqdn, app.config['PUPPET_DEFAULT_ENVIRONMENT']))
 			g.db.commit()
+			cortex.lib.puppet.invalidate_node_config(fqdn)
 			app.logger.info('Created Puppet ENC entry for certname "' + fqdn + '"')
 
 	# Get the satellite registration key (if any)
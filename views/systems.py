@@ -258,6 +258,10 @@ def systems_add_existing():
 		# Commit
 		g.db.commit()
 
+		# Make sure the ENC isn't serving anything cached for the certname
+		if len(puppet_env) > 0:
+			cortex.lib.puppet.invalidate_node_config(hostname + ".soton.ac.uk")
+
 		# If we're linking to VMware
 		if 'link_vmware' in request.form:
 			# Search for a VM with the correct name
@@ -286,6 +290,10 @@ def systems_add_existing():
 				curd.execute("UPDATE `systems` SET `cmdb_id` = %s WHERE `id` = %s", (ci_results[0]['sys_id'], system_id))
 				g.db.commit()
 
+				# The CMDB link is included in the Puppet ENC document
+				if len(puppet_env) > 0:
+					cortex.lib.puppet.invalidate_node_config(hostname + ".soton.ac.uk")
+
 		cortex.lib.core.log(__name__, "systems.add.existing", "System manually added, id " + str(system_id), related_id=system_id)
 		# Redirect to the system page for the system we just added
 		flash("System added", "alert-success")
@@ -821,6 +829,10 @@ def system_edit(system_id):
 			curd.execute('UPDATE `systems` SET `allocation_comment` = %s, `cmdb_id` = %s, `vmware_uuid` = %s, `enable_backup` = %s, `enable_backup_scripts` = %s, `review_status` = %s, `review_task` = %s, `expiry_date` = %s, `primary_owner_who`=%s, `primary_owner_role`=%s, `secondary_owner_who`=%s, `secondary_owner_role`=%s WHERE `id` = %s', (request.form['allocation_comment'].strip(), cmdb_id, vmware_uuid, enable_backup, enable_backup_scripts, review_status, review_task, expiry_date, primary_owner_who, primary_owner_role, secondary_owner_who, secondary_owner_role, system_id))
 			g.db.commit()
 
+			# The CMDB link is included in the Puppet ENC document
+			if system['puppet_certname']:
+				cortex.lib.puppet.invalidate_node_config(system['puppet_certname'])
+
 			cortex.lib.core.log(__name__, "systems.edit", "System '" + system['name'] + "' edited, id " + str(system_id), related_id=system_id)
 
 			flash('System updated', "alert-success")
@@ -2,7 +2,7 @@
 import traceback
 
 import MySQLdb as mysql
-from flask import abort, g, render_template, request, session
+from flask import Response, abort, g, render_template, request, session, stream_with_context
 
 import cortex.lib.core
 import cortex.lib.puppet
@@ -92,10 +92,10 @@ def dashboard():
 
 	# Puppet Stats
 	try:
-		stats = {
-			'failed': len(cortex.lib.puppet.puppetdb_query('nodes', query='["extract","certname",["and",["=", "latest_report_status", "failed"], ["=", "latest_report_noop", false]]]')),
-			'changed': len(cortex.lib.puppet.puppetdb_query('nodes', query='["extract", "certname",["and",["=", "latest_report_status", "changed"],["=", "latest_report_noop", false]]]')),
-		}
+		stats = {'failed': 0, 'changed': 0}
+		for node in cortex.lib.puppet.puppetdb_get_node_snapshot().values():
+			if node['latest_report_status'] in stats and not node['latest_report_noop']:
+				stats[node['latest_report_status']] += 1
 	except Exception:
 		app.logger.error("Failed to talk to PuppetDB on dashboard:\n" + traceback.format_exc())
 		stats = {'failed': '???', 'changed': '???'}
@@ -172,3 +172,45 @@ def task_status_log(task_id):
 		hide_success = True
 
 	return cortex.lib.core.task_render_status(task, "tasks/status-log.html", hide_success=hide_success)
+
+################################################################################
+
+@app.route('/task/status/<int:task_id>/stream', methods=['GET'])
+@cortex.lib.user.login_required
+def task_status_stream(task_id):
+	"""Streams the events of a task to the browser as Server-Sent Events as
+	they are published by neocortex. The stream starts after the event given
+	in the Last-Event-ID header (or last_event_id argument) so that a browser
+	reconnecting catches up on whatever it missed. If too many streams are
+	already open, a 503 is returned and the browser polls instead."""
+
+	## Get the task details
+	task = cortex.lib.core.task_get(task_id)
+
+	# Return a 404 if we've not found the task
+	if not task:
+		abort(404)
+
+	# Check the user has the permission to view this task
+	if not task['username'] == session['username']:
+		if not does_user_have_permission("tasks.view"):
+			abort(403)
+
+	try:
+		last_event_id = int(request.headers.get('Last-Event-ID', request.args.get('last_event_id', -1)))
+	except ValueError:
+		last_event_id = -1
+
+	# Each stream ties up a worker for as long as it is open, so only allow so many
+	token = cortex.lib.core.task_event_stream_acquire()
+	if token is None:
+		return Response('Too many task event streams are open', status=503, mimetype='text/plain', headers={'Retry-After': '60'})
+
+	# Don't let nginx buffer the stream
+	response = Response(stream_with_context(cortex.lib.core.task_event_stream(task, last_event_id)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+	# Release the stream when the response is closed, whether or not it was
+	# ever started (g has gone by then, so hold on to the Redis connection)
+	rdb = g.redis
+	response.call_on_close(lambda: cortex.lib.core.task_event_stream_release(rdb, token))
+	return response
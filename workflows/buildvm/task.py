@@ -203,6 +203,10 @@ def run(helper, options):
 	task = helper.lib.vmware_clone_vm(si, template_name, system_name, vm_rpool=vm_rpool, vm_cluster=options["cluster"], custspec=vm_spec, vm_folder=vm_folder, vm_network=network_name, vm_datastore_cluster=cluster_storage_pools[options["cluster"]], folder_is_moid=folder_is_moid)
 	helper.lib.vmware_task_complete(task, "Failed to create the virtual machine")
 
+	# The names of the objects on the vCenter have changed, so make sure we
+	# don't look up anything from before the clone
+	helper.lib.vmware_invalidate_obj_index(si.RetrieveContent())
+
 	# End the event
 	helper.end_event(description="Created the virtual machine successfully")
 
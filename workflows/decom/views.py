@@ -97,8 +97,8 @@ def decom_step_check_complete(target_id):
 	if task["username"] != session.get("username", None):
 		return stderr("Permission Denied", "This task was started by {}. You do not have permission to complete a task you did not start.".format(task['username']), 403)
 
-	if task['status'] == 0:
-		# Still in progress
+	if cortex.lib.core.task_is_pending(task):
+		# Still queued or in progress
 		return redirect(url_for('decom_step_check_wait', target_id=task['id']))
 	if task['status'] == 1 or task['status'] == 3:
 		# Task complete